@@ -12,6 +12,7 @@ jpirko@redhat.com (Jiri Pirko)
 """
 
 import importlib.machinery
+import hashlib
 import signal
 import logging
 import os, stat
@@ -21,10 +22,12 @@ import socket
 import ctypes
 import multiprocessing
 import types
-from time import sleep
 from inspect import isclass
+import tarfile
+import tempfile
 from tempfile import NamedTemporaryFile
 from lnst.Common.Logs import log_exc_traceback
+from lnst.Common.LoggingHandler import unpack_log_batch
 from lnst.Common.PacketCapture import PacketCapture
 from lnst.Common.Utils import die_when_parent_die
 from lnst.Common.ExecCmd import exec_cmd, ExecCmdFail
@@ -86,10 +89,13 @@ class RemoteMethods:
         self._capture_files = {}
         self._copy_targets = {}
         self._copy_sources = {}
+        self._copy_hashes = {}
         self._system_config = {}
+        self._recipe_log_names = {}
 
         self._cache = ResourceCache(agent_config.get_option("cache", "dir"),
-                                    agent_config.get_option("cache", "expiration_period"))
+                                    agent_config.get_option("cache", "expiration_period"),
+                                    agent_config.get_option("cache", "size_limit"))
 
         self._dynamic_modules = {}
         self._dynamic_classes = {}
@@ -121,20 +127,23 @@ class RemoteMethods:
 
     def start_recipe(self, recipe_name):
         date = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        # the date has a resolution of a second, recipes started within the
+        # same second get a suffix so they don't overwrite each other's logs
+        key = (recipe_name, date)
+        count = self._recipe_log_names.get(key, 0)
+        self._recipe_log_names = {key: count + 1}
+        if count:
+            date = "%s_%d" % (date, count)
         self._log_ctl.set_recipe(recipe_name, expand=date)
-        sleep(1)
 
         if check_process_running("NetworkManager"):
             logging.warning("=============================================")
             logging.warning("NetworkManager is running on a agent machine!")
             logging.warning("=============================================")
 
-        for device in self._if_manager.get_devices():
-            try:
-                device.down()
-                device.store_cleanup_data()
-            except DeviceDisabled:
-                pass
+        # setting the devices down and reading their settings is done in
+        # bulk, the device database is in sync with the kernel afterwards
+        self._if_manager.snapshot_devices(self._if_manager.get_devices())
 
         return True
 
@@ -156,8 +165,20 @@ class RemoteMethods:
 
         setattr(Devices, cls_name, cls)
 
+    def map_device_classes(self, classes):
+        for cls_name, module_name in classes:
+            self.map_device_class(cls_name, module_name)
+
     def load_cached_module(self, module_name, res_hash):
         self._cache.renew_entry(res_hash)
+        self._load_module(module_name, res_hash)
+
+    def load_cached_modules(self, modules):
+        self._cache.renew_entries([res_hash for _, res_hash in modules])
+        for module_name, res_hash in modules:
+            self._load_module(module_name, res_hash)
+
+    def _load_module(self, module_name, res_hash):
         if module_name in self._dynamic_modules:
             return
         module_path = self._cache.get_path(res_hash)
@@ -231,6 +252,37 @@ class RemoteMethods:
         dev = self._if_manager.get_device(ifindex)
         return setattr(dev, name, value)
 
+    def dev_batch(self, ops):
+        """Executes a list of queued device operations in order
+
+        Each operation is a dictionary with the "op" key set to either
+        "method" or "setattr". Returns a list with one dictionary per
+        operation containing the "result" or the "exception" it raised, for
+        "setattr" the original value of the attribute is included as well so
+        that the controller doesn't need to query it separately.
+        """
+        results = []
+        for op in ops:
+            res = {"result": None, "exception": None}
+            try:
+                dev = self._if_manager.get_device(op["ifindex"])
+                if op["op"] == "method":
+                    method = getattr(dev, op["name"])
+                    res["result"] = method(*op["args"], **op["kwargs"])
+                elif op["op"] == "setattr":
+                    res["old_value"] = getattr(dev, op["name"])
+                    res["result"] = setattr(dev, op["name"], op["value"])
+                else:
+                    raise LnstError("Unknown batch operation '{}'".format(op["op"]))
+            except LnstError as exc:
+                log_exc_traceback()
+                res["exception"] = exc
+            except Exception as exc:
+                log_exc_traceback()
+                res["exception"] = LnstError(exc)
+            results.append(res)
+        return results
+
     def get_devices(self):
         devices = self._if_manager.get_devices()
         result = {}
@@ -268,16 +320,9 @@ class RemoteMethods:
         devices = self._if_manager.get_devices()
         matched = []
         for dev in devices:
-            dev_data = dev._get_if_data()
-            entry = {"name": dev.get_name(),
-                     "hwaddr": dev.get_hwaddr()}
-            for key, value in params.items():
-                if key not in dev_data or dev_data[key] != value:
-                    entry = None
-                    break
-
-            if entry is not None:
-                matched.append(entry)
+            if dev._match_if_data(params):
+                matched.append({"name": dev.name,
+                                "hwaddr": dev.hwaddr})
         return matched
 
     def destroy_devices(self):
@@ -446,6 +491,9 @@ class RemoteMethods:
 
         return False
 
+    def has_resources(self, res_hashes):
+        return self._cache.query_many(res_hashes)
+
     def add_resource_to_cache(self, res_type, local_path, name):
         if res_type == "file":
             self._cache.add_file_entry(local_path, name)
@@ -453,6 +501,25 @@ class RemoteMethods:
         else:
             raise Exception("Unknown resource type")
 
+    def add_resource_archive_to_cache(self, local_path, resources):
+        """Adds all files from a tar archive to the resource cache
+
+        :param resources: dictionary mapping the archive member names (the
+            digests of the files) to the resource names
+        """
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                with tarfile.open(local_path) as tar:
+                    for digest, res_name in resources.items():
+                        tar.extract(digest, tmp_dir, filter="data")
+                        if self._cache.query(digest):
+                            continue
+                        self._cache.add_file_entry(os.path.join(tmp_dir, digest),
+                                                   res_name)
+        finally:
+            os.remove(local_path)
+        return True
+
     def start_copy_to(self, filepath=None):
         if filepath in self._copy_targets:
             return ""
@@ -463,21 +530,29 @@ class RemoteMethods:
             tmpfile = NamedTemporaryFile("w+b", delete=False)
             filepath = tmpfile.name
             self._copy_targets[filepath] = tmpfile
+        self._copy_hashes[filepath] = hashlib.sha256()
 
         return filepath
 
     def copy_part_to(self, filepath, data):
         if self._copy_targets[filepath]:
             self._copy_targets[filepath].write(data)
+            self._copy_hashes[filepath].update(data)
             return True
 
         return False
 
-    def finish_copy_to(self, filepath):
+    def finish_copy_to(self, filepath, digest=None):
         if self._copy_targets[filepath]:
             self._copy_targets[filepath].close()
 
             del self._copy_targets[filepath]
+            received_digest = self._copy_hashes.pop(filepath).hexdigest()
+            if digest is not None and digest != received_digest:
+                os.remove(filepath)
+                raise LnstError("Transfer of file {} failed, sha256 mismatch "
+                                "({} != {})".format(filepath, received_digest,
+                                                    digest))
             return True
 
         return False
@@ -487,17 +562,24 @@ class RemoteMethods:
             return False
 
         self._copy_sources[filepath] = open(filepath, "rb")
+        self._copy_hashes[filepath] = hashlib.sha256()
         return True
 
     def copy_part_from(self, filepath, buffsize):
         data = self._copy_sources[filepath].read(buffsize)
+        self._copy_hashes[filepath].update(data)
         return data
 
     def finish_copy_from(self, filepath):
+        """Closes the transferred file
+
+        Returns the sha256 digest of the data sent by copy_part_from calls so
+        that the controller can verify the transfer.
+        """
         if filepath in self._copy_sources:
             self._copy_sources[filepath].close()
             del self._copy_sources[filepath]
-            return True
+            return self._copy_hashes.pop(filepath).hexdigest()
 
         return False
 
@@ -509,6 +591,7 @@ class RemoteMethods:
         for file_handle in self._copy_sources.values():
             file_handle.close()
         self._copy_sources = {}
+        self._copy_hashes = {}
 
     def add_namespace(self, netns):
         if netns in self._net_namespaces:
@@ -757,8 +840,9 @@ class RemoteMethods:
         return True
 
 class ServerHandler(ConnectionHandler):
-    def __init__(self, addr, agent_config):
+    def __init__(self, addr, agent_config, log_ctl=None):
         super(ServerHandler, self).__init__()
+        self._log_ctl = log_ctl
         self._netns_con_mapping = {}
         try:
             self._s_socket = socket.socket()
@@ -851,6 +935,10 @@ class ServerHandler(ConnectionHandler):
 
     def send_data_to_ctl(self, data):
         if self._c_socket != None:
+            if self._log_ctl is not None:
+                # logs shared the connection, send them ahead of the data
+                self._log_ctl.flush_transmit()
+
             if self._netns != None:
                 data = {"type": "from_netns",
                         "netns": self._netns,
@@ -965,7 +1053,7 @@ class Agent:
         self._job_context = JobContext()
         port = agent_config.get_option("environment", "rpcport")
         logging.info("Using RPC port %d." % port)
-        self._server_handler = ServerHandler(("", port), agent_config)
+        self._server_handler = ServerHandler(("", port), agent_config, log_ctl)
 
         self._net_namespaces = {}
 
@@ -981,6 +1069,11 @@ class Agent:
         self._finished = False
 
         self._log_ctl = log_ctl
+        self._log_ctl.set_transmit_options(
+            level=agent_config.get_option("logging", "transmit_level"),
+            batch_size=agent_config.get_option("logging", "batch_size"),
+            batch_interval=agent_config.get_option("logging", "batch_interval") / 1000,
+        )
 
     def run(self):
         while True:
@@ -999,6 +1092,8 @@ class Agent:
 
                 for msg in msgs:
                     self._process_msg(msg[1])
+
+                self._log_ctl.flush_transmit()
             except SystemCallException:
                 break
 
@@ -1030,26 +1125,34 @@ class Agent:
                     args = msg["args"]
                     kwargs = msg["kwargs"]
 
+                request_id = msg.get("request_id", None)
                 try:
                     result = method(*args, **kwargs)
                 except LnstError as e:
                     log_exc_traceback()
-                    response = {"type": "exception", "Exception": e}
+                    response = {"type": "exception", "Exception": e,
+                                "request_id": request_id}
 
                     self._server_handler.send_data_to_ctl(response)
                     return
 
-                response = {"type": "result", "result": result}
+                response = {"type": "result", "result": result,
+                            "request_id": request_id}
                 response = device_to_deviceref(response)
                 self._server_handler.send_data_to_ctl(response)
             else:
                 err = LnstError("Method '%s' not supported." % msg["method_name"])
-                response = {"type": "exception", "Exception": err}
+                response = {"type": "exception", "Exception": err,
+                            "request_id": msg.get("request_id", None)}
                 self._server_handler.send_data_to_ctl(response)
         elif msg["type"] == "log":
             logger = logging.getLogger()
             record = logging.makeLogRecord(msg["record"])
             logger.handle(record)
+        elif msg["type"] == "log_batch":
+            logger = logging.getLogger()
+            for record in unpack_log_batch(msg["records"]):
+                logger.handle(logging.makeLogRecord(record))
         elif msg["type"] == "exception":
             if msg["cmd_id"] != None:
                 logging.debug("Recieved an exception from command with id: %s"
@@ -1077,7 +1180,8 @@ class Agent:
                 self._server_handler.send_data_to_netns(netns, msg["data"])
             except LnstError as e:
                 log_exc_traceback()
-                response = {"type": "exception", "Exception": e}
+                response = {"type": "exception", "Exception": e,
+                            "request_id": msg["data"].get("request_id", None)}
 
                 self._server_handler.send_data_to_ctl(response)
                 return
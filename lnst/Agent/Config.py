@@ -12,6 +12,7 @@ olichtne@redhat.com (Ondrej Lichtner)
 
 import os
 import sys
+import logging
 from lnst.Common.Config import DefaultRPCPort, Config
 
 class AgentConfig(Config):
@@ -43,6 +44,29 @@ class AgentConfig(Config):
                 "action" : self.optionTimeval,
                 "name" : "expiration_period"}
 
+        self._options['cache']['size_limit'] = {\
+                "value" : 100*1024*1024, # 100 MiB
+                "additive" : False,
+                "action" : self.optionSize,
+                "name" : "size_limit"}
+
+        self._options['logging'] = dict()
+        self._options['logging']['transmit_level'] = {\
+                "value" : logging.DEBUG,
+                "additive" : False,
+                "action" : self.optionLogLevel,
+                "name" : "transmit_level"}
+        self._options['logging']['batch_size'] = {\
+                "value" : 100,
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "batch_size"}
+        self._options['logging']['batch_interval'] = {\
+                "value" : 100, # milliseconds
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "batch_interval"}
+
         self._options['security'] = dict()
         self._options['security']['auth_types'] = {\
                 "value" : "none",
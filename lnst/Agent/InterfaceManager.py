@@ -13,15 +13,20 @@ olichtne@redhat.com (Ondrej Lichtner)
 """
 
 import re
+import time
+import errno
 import select
 import socket
+import logging
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from lnst.Common.ExecCmd import exec_cmd
 from lnst.Common.DeviceError import (DeviceNotFound, DeviceConfigError,
         DeviceError)
 from lnst.Common.InterfaceManagerError import InterfaceManagerError
-from pyroute2 import IPRSocket
-from pyroute2.netlink import NLM_F_REQUEST, NLM_F_DUMP
+from pyroute2 import IPRSocket, IPRoute
+from pyroute2.netlink.exceptions import NetlinkError
+from pyroute2.netlink import NLM_F_REQUEST, NLM_F_DUMP, NLMSG_DONE
 from pyroute2.netlink.rtnl import RTMGRP_IPV4_IFADDR
 from pyroute2.netlink.rtnl import RTMGRP_IPV6_IFADDR
 from pyroute2.netlink.rtnl import RTMGRP_LINK
@@ -31,6 +36,7 @@ from pyroute2.netlink.rtnl import RTM_DELLINK
 from pyroute2.netlink.rtnl import RTM_NEWADDR
 from pyroute2.netlink.rtnl import RTM_GETADDR
 from pyroute2.netlink.rtnl import RTM_DELADDR
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
 
 NL_GROUPS = RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR | RTMGRP_LINK
 PF_BRIDGE = 7
@@ -40,10 +46,22 @@ class InterfaceManager(object):
         self._device_classes = {}
 
         self._devices = {} #ifindex to device
+        self._devices_by_name = {} #name to device
+        self._devices_by_hwaddr = {} #hwaddr string to list of devices
+        self._indexed_keys = {} #ifindex to (device, name, hwaddr) indexed
 
         self._nl_socket = IPRSocket()
         self._nl_socket.bind(groups=NL_GROUPS)
 
+        # sequence numbers of our own requests, multicast events always
+        # carry sequence number 0
+        self._nl_seq = 0
+        self._link_dump_seq = None
+        self._link_dump_seen = set()
+        self._addr_dump_seq = None
+        self._addr_dump_started = False
+        self._resync_needed = False
+
         self._msg_queue = deque()
 
         #TODO split DevlinkManager away from the InterfaceManager
@@ -80,25 +98,120 @@ class InterfaceManager(object):
                 if not len(rl):
                     break
                 self._msg_queue.extend(self._nl_socket.get())
-        except socket.error:
+        except socket.error as e:
+            if e.errno == errno.ENOBUFS:
+                # the kernel dropped some of the multicast events, the
+                # socket is still usable but the device database can't be
+                # trusted until it's resynchronized with a full dump
+                logging.debug("Netlink socket overrun, resynchronizing "
+                              "device database")
+                self._resync_needed = True
+                return []
             self.reconnect_netlink()
             return []
 
+    def _next_nl_seq(self):
+        self._nl_seq += 1
+        return self._nl_seq
+
     def rescan_devices(self):
+        """Resynchronizes the device database with a full netlink dump
+
+        Lookups don't need this, the database is kept up to date from the
+        netlink multicast events, use it only when the events can't be
+        trusted.
+        """
         self.request_netlink_dump()
         self.handle_netlink_msgs()
 
     def request_netlink_dump(self):
+        self._link_dump_seq = self._next_nl_seq()
+        self._link_dump_seen = set()
         self._nl_socket.put(
-            None, RTM_GETLINK, msg_flags=NLM_F_REQUEST | NLM_F_DUMP
+            None, RTM_GETLINK, msg_flags=NLM_F_REQUEST | NLM_F_DUMP,
+            msg_seq=self._link_dump_seq
         )
+
+    def _request_addr_dump(self):
+        # only one dump can run on a netlink socket at a time, the kernel
+        # replies with EBUSY otherwise, so this is requested only after the
+        # link dump is done
+        self._addr_dump_seq = self._next_nl_seq()
+        self._addr_dump_started = False
         self._nl_socket.put(
-            None, RTM_GETADDR, msg_flags=NLM_F_REQUEST | NLM_F_DUMP
+            None, RTM_GETADDR, msg_flags=NLM_F_REQUEST | NLM_F_DUMP,
+            msg_seq=self._addr_dump_seq
         )
+        self.pull_netlink_messages_into_queue()
+
+    def wait_for_sync(self, timeout=5):
+        """Resynchronizes the device database and waits until it's done
+
+        Unlike rescan_devices() this doesn't return before the kernel replied
+        to both the link and the address dump, so the database reflects all
+        the changes made before the call.
+        """
+        self.request_netlink_dump()
+        end_time = time.monotonic() + timeout
+        self.handle_netlink_msgs()
+        while self._link_dump_seq is not None or self._addr_dump_seq is not None:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                raise InterfaceManagerError("Timed out waiting for the netlink dump")
+            select.select([self._nl_socket], [], [], remaining)
+            self.handle_netlink_msgs()
+
+    def snapshot_devices(self, devices, max_workers=8):
+        """Sets the devices down and stores their cleanup data in bulk
+
+        The links are set down through a single netlink socket and the
+        device database is synchronized once afterwards, instead of once per
+        device. The ethtool based part of the cleanup data is collected for
+        multiple devices at a time.
+        """
+        devices = [dev for dev in devices if dev._enabled and not dev._deleted]
+
+        with IPRoute() as ipr:
+            for dev in devices:
+                try:
+                    ipr.link("set", index=dev.ifindex, state="down")
+                except NetlinkError as e:
+                    logging.debug("Setting device %s down failed: %s",
+                                  dev.name, e)
+        self.wait_for_sync()
+
+        if not devices:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as executor:
+            for dev, future in [(dev, executor.submit(dev.store_cleanup_data))
+                                for dev in devices]:
+                try:
+                    future.result()
+                except DeviceError as e:
+                    logging.debug("Storing cleanup data of device %s failed: %s",
+                                  dev.name, e)
+
+    def refresh_device(self, ifindex):
+        """Requests fresh link data of a single device
+
+        Needed for data that the kernel doesn't send events for, e.g. link
+        statistics.
+        """
+        msg = ifinfmsg()
+        msg["index"] = ifindex
+        self._nl_socket.put(msg, RTM_GETLINK, msg_flags=NLM_F_REQUEST,
+                            msg_seq=self._next_nl_seq())
+        self.handle_netlink_msgs()
 
     def handle_netlink_msgs(self):
         self.pull_netlink_messages_into_queue()
 
+        while self._resync_needed:
+            self._resync_needed = False
+            self.request_netlink_dump()
+            self.pull_netlink_messages_into_queue()
+
         while len(self._msg_queue):
             msg = self._msg_queue.popleft()
             self._handle_netlink_msg(msg)
@@ -108,10 +221,81 @@ class InterfaceManager(object):
             # dl_port = self._dl_manager.get_port(device.name)
             # device._set_devlink(dl_port)
 
+    def _track_dump_msg(self, msg):
+        seq = msg['header']['sequence_number']
+        if seq == 0:
+            return
+
+        if seq == self._link_dump_seq:
+            if msg['header']['type'] == NLMSG_DONE:
+                self._link_dump_seq = None
+                self._prune_devices(self._link_dump_seen)
+                self._request_addr_dump()
+            elif msg['header']['type'] == RTM_NEWLINK:
+                self._link_dump_seen.add(msg['index'])
+        elif seq == self._addr_dump_seq:
+            if not self._addr_dump_started:
+                # the dump is authoritative, drop addresses that we might
+                # have missed a RTM_DELADDR for
+                self._addr_dump_started = True
+                for dev in self._devices.values():
+                    dev._ip_addrs = []
+            if msg['header']['type'] == NLMSG_DONE:
+                self._addr_dump_seq = None
+
+    def _prune_devices(self, present):
+        for ifindex in list(self._devices.keys()):
+            if ifindex not in present:
+                self._remove_device(ifindex, {"type": "dev_deleted",
+                                              "ifindex": ifindex})
+
+    def _remove_device(self, ifindex, del_msg):
+        self._unindex_device(ifindex)
+
+        dev = self._devices.pop(ifindex)
+        dev._deleted = True
+
+        self._server_handler.send_data_to_ctl(del_msg)
+
+    def _index_device(self, dev):
+        self._unindex_device(dev.ifindex)
+
+        name = dev.name
+        hwaddr = str(dev.hwaddr) if dev.hwaddr is not None else None
+        if name is not None:
+            self._devices_by_name[name] = dev
+        if hwaddr is not None:
+            self._devices_by_hwaddr.setdefault(hwaddr, []).append(dev)
+        self._indexed_keys[dev.ifindex] = (dev, name, hwaddr)
+
+    def _unindex_device(self, ifindex):
+        try:
+            dev, name, hwaddr = self._indexed_keys.pop(ifindex)
+        except KeyError:
+            return
+
+        if self._devices_by_name.get(name) is dev:
+            del self._devices_by_name[name]
+        if hwaddr in self._devices_by_hwaddr:
+            devs = [i for i in self._devices_by_hwaddr[hwaddr] if i is not dev]
+            if devs:
+                self._devices_by_hwaddr[hwaddr] = devs
+            else:
+                del self._devices_by_hwaddr[hwaddr]
+
     def _handle_netlink_msg(self, msg):
+        self._track_dump_msg(msg)
+
+        if msg['header']['type'] == RTM_NEWLINK and msg['family'] == PF_BRIDGE:
+            # bridge port info, doesn't carry the generic link attributes
+            return
+
         if msg['header']['type'] in [RTM_NEWLINK, RTM_NEWADDR, RTM_DELADDR]:
             if msg['index'] in self._devices:
-                self._devices[msg['index']]._update_netlink(msg)
+                dev = self._devices[msg['index']]
+                dev._update_netlink(msg)
+                if msg['header']['type'] == RTM_NEWLINK:
+                    self._index_device(dev)
             elif msg['header']['type'] == RTM_NEWLINK:
                 if msg['ifi_type'] == 772:
                     dev = self._device_classes["LoopbackDevice"](self)
@@ -119,6 +303,7 @@ class InterfaceManager(object):
                     dev = self._device_classes["Device"](self)
                 dev._init_netlink(msg)
                 self._devices[msg['index']] = dev
+                self._index_device(dev)
 
                 update_msg = {"type": "dev_created",
                               "dev_data": dev._get_if_data()}
@@ -139,11 +324,6 @@ class InterfaceManager(object):
 
                     return None
 
-                dev = self._devices[msg['index']]
-                dev._deleted = True
-
-                del self._devices[msg['index']]
-
                 # the event may have been a move of device to netns
                 del_msg = {"ifindex": msg['index']}
                 if _netlink_msg_attr(msg, 'IFLA_NEW_NETNSID') is not None:
@@ -152,54 +332,47 @@ class InterfaceManager(object):
                 else:
                     del_msg["type"] = "dev_deleted"
 
-                self._server_handler.send_data_to_ctl(del_msg)
+                self._remove_device(msg['index'], del_msg)
         else:
             return
 
     def untrack_device(self, dev):
         if dev.ifindex in self._devices:
+            self._unindex_device(dev.ifindex)
             del self._devices[dev.ifindex]
 
     def get_device(self, ifindex):
-        self.rescan_devices()
+        self.handle_netlink_msgs()
         if ifindex in self._devices:
             return self._devices[ifindex]
         else:
             raise DeviceNotFound()
 
     def get_devices(self):
-        self.rescan_devices()
+        self.handle_netlink_msgs()
         return list(self._devices.values())
 
     def get_device_by_hwaddr(self, hwaddr):
-        self.rescan_devices()
-        for dev in list(self._devices.values()):
-            if dev.hwaddr == hwaddr:
-                return dev
-        raise DeviceNotFound()
+        self.handle_netlink_msgs()
+        try:
+            return self._devices_by_hwaddr[str(hwaddr)][0]
+        except KeyError:
+            raise DeviceNotFound()
 
     def get_device_by_name(self, name):
-        self.rescan_devices()
-        for dev in list(self._devices.values()):
-            if dev.name == name:
-                return dev
-        raise DeviceNotFound()
+        self.handle_netlink_msgs()
+        try:
+            return self._devices_by_name[name]
+        except KeyError:
+            raise DeviceNotFound()
 
     def get_device_by_params(self, params):
-        self.rescan_devices()
-        matched = None
+        self.handle_netlink_msgs()
         for dev in list(self._devices.values()):
-            matched = dev
-            dev_data = dev.get_if_data()
-            for key, value in params.items():
-                if key not in dev_data or dev_data[key] != value:
-                    matched = None
-                    break
-
-            if matched:
-                break
+            if dev._match_if_data(params):
+                return dev
 
-        return matched
+        return None
 
     def deconfigure_all(self):
         for dev in self._devices.values():
@@ -223,9 +396,11 @@ class InterfaceManager(object):
         while len(self._msg_queue):
             msg = self._msg_queue.popleft()
             if msg.get_attr("IFLA_IFNAME") == device.name:
+                self._track_dump_msg(msg)
                 device_found = True
                 device._init_netlink(msg)
                 self._devices[msg['index']] = device
+                self._index_device(device)
             else:
                 self._handle_netlink_msg(msg)
 
@@ -255,6 +430,7 @@ class InterfaceManager(object):
     def replace_dev(self, if_id, dev):
         del self._devices[if_id]
         self._devices[if_id] = dev
+        self._index_device(dev)
 
     def _is_name_used(self, name):
         self.rescan_devices()
@@ -118,6 +118,7 @@ class Job(object):
             result["job_id"] = self._id
             result["result"] = job_result
 
+        self._log_ctl.flush_transmit()
         send_data(self._child_pipe, result)
         self._child_pipe.close()
 
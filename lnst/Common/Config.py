@@ -13,6 +13,7 @@ olichtne@redhat.com (Ondrej Lichtner)
 import os
 import sys
 import re
+import logging
 from lnst.Common.Utils import bool_it
 from lnst.Common.NetUtils import verify_mac_address
 from lnst.Common.Colours import get_preset_conf
@@ -202,6 +203,13 @@ class Config():
             raise ConfigError(msg)
         return int(option)
 
+    def optionInt(self, option, cfg_path):
+        try:
+            return int(option)
+        except ValueError:
+            msg = "Option expects a number, got '%s'." % option
+            raise ConfigError(msg)
+
     def optionPath(self, option, cfg_path):
         exp_path = os.path.expanduser(option)
         abs_path = os.path.join(os.path.dirname(cfg_path), exp_path)
@@ -255,6 +263,29 @@ class Config():
 
         return timeval
 
+    def optionSize(self, option, cfg_path):
+        size_re = r"^([0-9]+)\s*([kKmMgG]?)$"
+        size_match = re.match(size_re, option.strip())
+        if size_match is None:
+            msg = "Incorrect size format '%s', expected a number optionally " \
+                  "followed by K, M or G." % option
+            raise ConfigError(msg)
+
+        multiplier = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+        value, unit = size_match.groups()
+        return int(value) * multiplier[unit.lower()]
+
+    def optionLogLevel(self, option, cfg_path):
+        option = option.strip()
+        if option.isdigit():
+            return int(option)
+
+        level = logging.getLevelName(option.upper())
+        if not isinstance(level, int):
+            msg = "Unknown log level '%s'." % option
+            raise ConfigError(msg)
+        return level
+
     def optionColour(self, option, cfg_path):
         colour = option.split()
         if len(colour) != 3:
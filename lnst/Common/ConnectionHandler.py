@@ -11,7 +11,8 @@ __author__ = """
 olichtne@redhat.com (Ondrej Lichtner)
 """
 
-import select
+import os
+import selectors
 import socket
 import logging
 import traceback
@@ -43,10 +44,43 @@ def recv_data(s):
     return data
 
 
+def has_buffered_data(s):
+    """True if another message can be received from s without blocking"""
+    if isinstance(s, SecureSocket):
+        return s.has_buffered_msg()
+    elif isinstance(s, Connection):
+        return s.poll(0)
+    return False
+
+
 class ConnectionHandler(object):
     def __init__(self):
         self._connections = []
         self._connection_mapping = {}
+        self._selector = None
+        self._selector_pid = None
+
+    def _get_selector(self, connections):
+        """Returns a selector watching exactly the given connections
+
+        The registrations are kept between calls and only updated by the
+        difference, connections can also be added to the _connections list
+        directly by subclasses. A new selector is created after fork since
+        the epoll instance would be shared with the parent process.
+        """
+        if self._selector is None or self._selector_pid != os.getpid():
+            self._selector = selectors.DefaultSelector()
+            self._selector_pid = os.getpid()
+
+        registered = [key.fileobj for key in self._selector.get_map().values()]
+        for c in registered:
+            if c not in connections:
+                self._selector.unregister(c)
+
+        for c in connections:
+            if c not in registered:
+                self._selector.register(c, selectors.EVENT_READ)
+        return self._selector
 
     def check_connections(self, timeout=None):
         return self._check_connections(list(self._connections), timeout)
@@ -65,9 +99,11 @@ class ConnectionHandler(object):
 
         requests = []
         try:
-            rl, wl, xl = select.select(connections, [], [], timeout)
-        except select.error:
+            selector = self._get_selector(connections)
+            rl = [key.fileobj for key, events in selector.select(timeout)]
+        except OSError:
             logging.debug(traceback.format_exc())
+            self._selector = None
             return []
         for f in rl:
             f_ready = True
@@ -84,10 +120,9 @@ class ConnectionHandler(object):
                         requests.append((id, data))
 
                     if f_ready:
-                        #poll the file descriptor if there is another message
-                        rll, _, _ = select.select([f], [], [], 0)
-                        if rll == []:
-                            f_ready = False
+                        # keep processing messages that were already received
+                        # in the same read, the rest is signalled by select
+                        f_ready = has_buffered_data(f)
 
                 except socket.error:
                     f_ready = False
@@ -138,4 +173,6 @@ class ConnectionHandler(object):
         # Remove things that can't be pickled
         state['_connections'] = []
         state['_connection_mapping'] = {}
+        state['_selector'] = None
+        state['_selector_pid'] = None
         return state
\ No newline at end of file
@@ -0,0 +1,305 @@
+"""
+Defines the LogStore class, an append-only on-disk storage of log records.
+
+The store is a directory containing a single data file with the pickled
+records of all sources (controller, agents) and one index file per source.
+Each index entry is a fixed size (timestamp, data offset) pair so records of a
+source can be counted, accessed by position and filtered by time without
+loading or unpickling anything else.
+
+Copyright 2023 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+__author__ = """
+olichtne@redhat.com (Ondrej Lichtner)
+"""
+
+import io
+import os
+import json
+import struct
+import pickle
+import logging
+import threading
+from collections.abc import Mapping, Sequence
+
+_RECORD_HEADER = struct.Struct("!I")
+_INDEX_ENTRY = struct.Struct("!dQ")
+_INDEX_READ_ENTRIES = 4096
+_INDEX_PENDING_SIZE = 64 * 1024
+
+# LogRecord attributes stored positionally, anything else is kept in a dict
+_RECORD_FIELDS = ("name", "msg", "levelno", "levelname", "pathname",
+                  "filename", "module", "lineno", "funcName", "created",
+                  "msecs", "relativeCreated", "thread", "threadName",
+                  "processName", "process", "exc_text", "stack_info")
+_RECORD_SKIP = set(_RECORD_FIELDS) | {"args", "exc_info", "message", "asctime"}
+
+
+def _pack_record(record):
+    d = record.__dict__
+    if record.exc_info and not record.exc_text:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+
+    fields = [d.get(name, None) for name in _RECORD_FIELDS]
+    fields[1] = record.getMessage()
+    extra = {k: v for k, v in d.items() if k not in _RECORD_SKIP}
+    return pickle.dumps((tuple(fields), extra), pickle.HIGHEST_PROTOCOL)
+
+
+def _unpack_record(data):
+    fields, extra = pickle.loads(data)
+    d = dict(zip(_RECORD_FIELDS, fields))
+    d.update(extra)
+    return logging.makeLogRecord(d)
+
+
+class LogStoreError(Exception):
+    pass
+
+
+class LogStore(Mapping):
+    """Append-only store of log records, indexed by source and time
+
+    The store behaves as a read-only mapping of source names to sequences of
+    logging.LogRecord objects, the records are read from disk lazily.
+
+    Records are added through writers returned by the writer() method, these
+    can be used as the target list of an ExportHandler.
+    """
+    DATA_FILE = "records"
+    SOURCES_FILE = "sources.json"
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._data_file = None
+        self._index_files = {}
+        self._pending_index = {}
+        self._embedded = None
+
+        if path is not None and os.path.isdir(path):
+            self._load_sources()
+
+    @property
+    def path(self):
+        return self._path
+
+    def _load_sources(self):
+        try:
+            with open(os.path.join(self._path, self.SOURCES_FILE), "r") as f:
+                self._sources = json.load(f)
+        except FileNotFoundError:
+            self._sources = {}
+
+    def _save_sources(self):
+        tmp_path = os.path.join(self._path, self.SOURCES_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._sources, f)
+        os.replace(tmp_path, os.path.join(self._path, self.SOURCES_FILE))
+
+    def writer(self, source):
+        """Returns an object with an append(record) method for the source"""
+        if self._embedded is not None:
+            raise LogStoreError("Log store imported from an archive is read only")
+
+        with self._lock:
+            if source not in self._sources:
+                os.makedirs(self._path, exist_ok=True)
+                self._sources[source] = "index.%d" % len(self._sources)
+                self._save_sources()
+        return _LogStoreWriter(self, source)
+
+    def append(self, source, record):
+        data = _pack_record(record)
+
+        with self._lock:
+            if self._data_file is None:
+                self._data_file = open(
+                    os.path.join(self._path, self.DATA_FILE), "ab"
+                )
+            offset = self._data_file.tell()
+            self._data_file.write(_RECORD_HEADER.pack(len(data)))
+            self._data_file.write(data)
+
+            # index entries are written only after the data they point to
+            pending = self._pending_index.setdefault(source, bytearray())
+            pending += _INDEX_ENTRY.pack(record.created, offset)
+            if len(pending) >= _INDEX_PENDING_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if self._data_file is not None:
+            self._data_file.flush()
+
+        for source, pending in self._pending_index.items():
+            if not pending:
+                continue
+            index_file = self._index_files.get(source)
+            if index_file is None:
+                index_file = open(
+                    os.path.join(self._path, self._sources[source]), "ab"
+                )
+                self._index_files[source] = index_file
+            index_file.write(pending)
+            index_file.flush()
+            del pending[:]
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._data_file is not None:
+                self._data_file.close()
+                self._data_file = None
+            for index_file in self._index_files.values():
+                index_file.close()
+            self._index_files = {}
+
+    @classmethod
+    def from_files(cls, path, files):
+        """Creates a read only store from a dict of its file contents
+
+        The path is only informational, nothing is read from it.
+        """
+        store = cls.__new__(cls)
+        store.__init__(None)
+        store._path = path
+        store._embedded = files
+        store._sources = json.loads(files[cls.SOURCES_FILE])
+        return store
+
+    def file_names(self):
+        """Names of the files making up the store"""
+        if not self._sources:
+            return []
+        return [self.DATA_FILE, self.SOURCES_FILE] + list(self._sources.values())
+
+    def open_file(self, name):
+        """Opens one of the files of the store for reading in binary mode"""
+        return self._open(name)
+
+    def _open(self, name):
+        if self._embedded is not None:
+            return io.BytesIO(self._embedded[name])
+        try:
+            return open(os.path.join(self._path, name), "rb")
+        except FileNotFoundError:
+            if name == self.DATA_FILE or name in self._sources.values():
+                return io.BytesIO()
+            raise LogStoreError("Log store files missing in '%s'" % self._path)
+
+    def _read_record(self, data_file, offset):
+        data_file.seek(offset)
+        size, = _RECORD_HEADER.unpack(data_file.read(_RECORD_HEADER.size))
+        return _unpack_record(data_file.read(size))
+
+    def _index_entries(self, source, start=0, stop=None):
+        self.flush()
+        with self._open(self._sources[source]) as index_file:
+            index_file.seek(start * _INDEX_ENTRY.size)
+            remaining = None if stop is None else max(stop - start, 0)
+            while remaining is None or remaining > 0:
+                count = _INDEX_READ_ENTRIES
+                if remaining is not None:
+                    count = min(count, remaining)
+                    remaining -= count
+                chunk = index_file.read(count * _INDEX_ENTRY.size)
+                chunk = chunk[:len(chunk) - len(chunk) % _INDEX_ENTRY.size]
+                if not chunk:
+                    break
+                yield from _INDEX_ENTRY.iter_unpack(chunk)
+
+    def _index_len(self, source):
+        self.flush()
+        if self._embedded is not None:
+            return len(self._embedded[self._sources[source]]) // _INDEX_ENTRY.size
+        try:
+            size = os.path.getsize(os.path.join(self._path, self._sources[source]))
+        except FileNotFoundError:
+            return 0
+        return size // _INDEX_ENTRY.size
+
+    def records(self, source, start=0, stop=None, since=None, until=None):
+        """Iterates over the records of a source
+
+        start and stop select records by position, since and until by the
+        record creation time, the data of records outside of the range isn't
+        read at all.
+        """
+        with self._open(self.DATA_FILE) as data_file:
+            for created, offset in self._index_entries(source, start, stop):
+                if since is not None and created < since:
+                    continue
+                if until is not None and created > until:
+                    continue
+                yield self._read_record(data_file, offset)
+
+    def __getitem__(self, source):
+        if source not in self._sources:
+            raise KeyError(source)
+        return LogStoreView(self, source)
+
+    def __iter__(self):
+        return iter(list(self._sources))
+
+    def __len__(self):
+        return len(self._sources)
+
+    def __getstate__(self):
+        # files of the store aren't pickled, only referenced
+        return {"path": self._path, "sources": dict(self._sources),
+                "embedded": self._embedded}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+        self._embedded = state["embedded"]
+        if self._embedded is not None or not self._sources:
+            self._sources = state["sources"]
+
+
+class LogStoreView(Sequence):
+    """Lazily loaded sequence of the records of a single LogStore source"""
+    def __init__(self, store, source):
+        self._store = store
+        self._source = source
+
+    @property
+    def source(self):
+        return self._source
+
+    def __len__(self):
+        return self._store._index_len(self._source)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+
+        length = len(self)
+        if i < 0:
+            i += length
+        if i < 0 or i >= length:
+            raise IndexError("log record index out of range")
+        return next(self._store.records(self._source, i, i + 1))
+
+    def __iter__(self):
+        return self._store.records(self._source)
+
+    def between(self, since=None, until=None):
+        """Iterates over records created in the given time range"""
+        return self._store.records(self._source, since=since, until=until)
+
+
+class _LogStoreWriter(object):
+    def __init__(self, store, source):
+        self._store = store
+        self._source = source
+
+    def append(self, record):
+        self._store.append(self._source, record)
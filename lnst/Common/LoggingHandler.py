@@ -14,11 +14,19 @@ __author__ = """
 olichtne@redhat.com (Ondrej Lichtner)
 """
 
+import os
+import zlib
+import time
+import struct
 import pickle
+import select
 import logging
+import tempfile
 import xmlrpc.client
 from lnst.Common.ConnectionHandler import send_data
 
+_SPOOL_HEADER = struct.Struct("!I")
+
 class LogBuffer(logging.Handler):
     """
     Handler used for buffering log messages. Compared to the BufferingHandler
@@ -63,11 +71,32 @@ class LogBuffer(logging.Handler):
         logging.Handler.close(self)
 
 class TransmitHandler(logging.Handler):
-    def __init__(self, target):
+    """
+    Handler sending log records to the other end of a connection.
+
+    Records are not sent one by one, they are collected and sent as a single
+    compressed "log_batch" message once batch_size records are pending or the
+    oldest pending record is older than batch_interval seconds.
+
+    If the target is not ready to accept more data (the controller, or the
+    parent process, isn't reading fast enough) the batch is written to a local
+    spool file instead of blocking the agent. Spooled batches are sent before
+    any new ones once the target catches up, or when flush() is called.
+    """
+    def __init__(self, target, batch_size=100, batch_interval=0.1):
         logging.Handler.__init__(self)
         self.target = target
         self._origin_name = None
 
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._pending = []
+        self._pending_since = None
+        self._flushing = False
+
+        self._spool = None
+        self._spool_read_pos = 0
+
     def set_origin_name(self, name):
         self._origin_name = name
 
@@ -79,14 +108,106 @@ class TransmitHandler(logging.Handler):
         if self._origin_name != None:
             r['origin_name'] = self._origin_name
 
-        data = {"type": "log", "record": r}
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append(r)
 
-        send_data(self.target, data)
+        if self._flushing:
+            # logged while sending a batch, will go out with the next one
+            return
+
+        if (len(self._pending) >= self._batch_size or
+                time.monotonic() - self._pending_since >= self._batch_interval):
+            self._send_pending(block=False)
+
+    def flush(self):
+        """Sends all spooled and pending records, blocking if necessary"""
+        self.acquire()
+        try:
+            if not self._flushing:
+                self._send_pending(block=True)
+        finally:
+            self.release()
+
+    def _send_pending(self, block):
+        self._flushing = True
+        try:
+            batch = None
+            if self._pending:
+                batch = zlib.compress(pickle.dumps(self._pending), 1)
+                self._pending = []
+                self._pending_since = None
+
+            if not self._send_spooled(block):
+                if batch is not None:
+                    self._spool_batch(batch)
+                return
+
+            if batch is not None:
+                if not (block or self._target_ready()) or \
+                   not self._send_batch(batch):
+                    self._spool_batch(batch)
+        finally:
+            self._flushing = False
+
+    def _send_batch(self, batch):
+        return send_data(self.target, {"type": "log_batch", "records": batch})
+
+    def _target_ready(self):
+        try:
+            _, wl, _ = select.select([], [self.target], [], 0)
+        except (OSError, ValueError):
+            return False
+        return wl != []
+
+    def _spool_batch(self, batch):
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile(prefix="lnst-log-spool-")
+        self._spool.seek(0, os.SEEK_END)
+        self._spool.write(_SPOOL_HEADER.pack(len(batch)))
+        self._spool.write(batch)
+
+    def _send_spooled(self, block):
+        """Backfills the spooled batches, returns True if none are left"""
+        if self._spool is None:
+            return True
+
+        while True:
+            self._spool.seek(self._spool_read_pos)
+            header = self._spool.read(_SPOOL_HEADER.size)
+            if len(header) < _SPOOL_HEADER.size:
+                break
+
+            if not (block or self._target_ready()):
+                return False
+
+            batch_len, = _SPOOL_HEADER.unpack(header)
+            if not self._send_batch(self._spool.read(batch_len)):
+                return False
+            self._spool_read_pos += _SPOOL_HEADER.size + batch_len
+
+        self._spool.close()
+        self._spool = None
+        self._spool_read_pos = 0
+        return True
 
     def close(self):
+        self.acquire()
+        try:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+            self._pending = []
+        finally:
+            self.release()
         logging.Handler.close(self)
 
 
+def unpack_log_batch(batch):
+    """Returns the list of log record dicts sent in a log_batch message"""
+    return pickle.loads(zlib.decompress(batch))
+
+
 class ExportHandler(logging.Handler):
     def __init__(self, logs):
         logging.Handler.__init__(self)
@@ -12,8 +12,10 @@ jzupka@redhat.com (Jiri Zupka)
 import os, sys, shutil
 from logging import Formatter
 import logging.handlers
+import threading
 import traceback
 from lnst.Common.LoggingHandler import TransmitHandler, ExportHandler
+from lnst.Common.LogStore import LogStore
 from lnst.Common.Colours import decorate_with_preset, strip_colours
 
 def log_exc_traceback():
@@ -21,6 +23,45 @@ def log_exc_traceback():
     exception = traceback.format_exception(cmd_type, value, tb)
     logging.debug(''.join(exception))
 
+class ThreadLogCapture(logging.Filter):
+    """Holds back records logged to the root logger from selected threads
+
+    While the capture is active (as a context manager), records logged
+    directly to the root logger by threads that called capture_thread() are
+    stored in the list passed to it instead of being handled. They can be
+    emitted later with emit_records() in an order independent of thread
+    scheduling.
+    """
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self._records = {}
+
+    def __enter__(self):
+        logging.getLogger().addFilter(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        logging.getLogger().removeFilter(self)
+
+    def capture_thread(self, records):
+        self._records[threading.get_ident()] = records
+
+    def release_thread(self):
+        self._records.pop(threading.get_ident(), None)
+
+    def filter(self, record):
+        records = self._records.get(threading.get_ident())
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    @staticmethod
+    def emit_records(records):
+        logger = logging.getLogger()
+        for record in records:
+            logger.handle(record)
+
 class MultilineFormatter(Formatter): # addr:17 level:7
     _ADDR_WIDTH  = 17
     _NETNS_WIDTH = 8
@@ -101,7 +142,7 @@ class LoggingCtl:
     agents = {}
     transmit_handler = None
     _id_seq = 0
-    log_list = None
+    log_store = None
 
     def __init__(self, debug=False, log_dir=None, log_subdir="", colours=True):
         #clear any previously set handlers
@@ -115,6 +156,9 @@ class LoggingCtl:
                 logger.removeHandler(i)
 
         self._origin_name = None
+        self._transmit_level = logging.NOTSET
+        self._transmit_batch_size = 100
+        self._transmit_batch_interval = 0.1
 
         if log_dir != None:
             self.log_folder = os.path.abspath(os.path.join(log_dir, log_subdir))
@@ -177,9 +221,11 @@ class LoggingCtl:
         logger.addHandler(recipe_debug)
 
         # set the export_handler
-        self.log_list = {}
-        self.log_list["controller"] = []
-        self.export_handler = self._create_export_handler(self.log_list["controller"])
+        if self.log_store is not None:
+            self.log_store.close()
+        self.log_store = LogStore(os.path.join(self.recipe_log_path, "log_store"))
+        self.export_handler = self._create_export_handler(
+            self.log_store.writer("controller"))
         self.export_handler.setLevel(logging.DEBUG)
         logger.addHandler(self.export_handler)
 
@@ -190,7 +236,9 @@ class LoggingCtl:
         self.recipe_handlers = (None, None)
         logger.removeHandler(self.export_handler)
         self.export_handler = None
-        self.log_list = None
+        if self.log_store is not None:
+            self.log_store.close()
+        self.log_store = None
 
     def add_agent(self, agent_id):
         agent_log_path = os.path.join(self.recipe_log_path, agent_id)
@@ -204,8 +252,8 @@ class LoggingCtl:
         logger.addHandler(agent_info)
         logger.addHandler(agent_debug)
 
-        self.log_list[agent_id] = []
-        export_handler = self._create_export_handler(self.log_list[agent_id])
+        export_handler = self._create_export_handler(
+            self.log_store.writer(agent_id))
         logger.addHandler(export_handler)
 
         self.agents[agent_id] = (agent_info, agent_debug, export_handler)
@@ -227,10 +275,27 @@ class LoggingCtl:
         record = logging.makeLogRecord(log_record)
         logger.handle(record)
 
+    def set_transmit_options(self, level=logging.NOTSET, batch_size=100,
+                             batch_interval=0.1):
+        """Configures the handler used for sending logs to the other side
+
+        Only records of the given level and above are sent. Records are sent
+        in batches of up to batch_size records, delayed by up to
+        batch_interval seconds.
+        """
+        self._transmit_level = level
+        self._transmit_batch_size = batch_size
+        self._transmit_batch_interval = batch_interval
+
     def set_connection(self, target):
         if self.transmit_handler != None:
             self.cancel_connection()
-        self.transmit_handler = TransmitHandler(target)
+        self.transmit_handler = TransmitHandler(
+            target,
+            batch_size=self._transmit_batch_size,
+            batch_interval=self._transmit_batch_interval,
+        )
+        self.transmit_handler.setLevel(self._transmit_level)
 
         self.transmit_handler.set_origin_name(self._origin_name)
 
@@ -240,10 +305,15 @@ class LoggingCtl:
         for k in list(self.agents.keys()):
             self.remove_agent(k)
 
+    def flush_transmit(self):
+        if self.transmit_handler != None:
+            self.transmit_handler.flush()
+
     def cancel_connection(self):
         if self.transmit_handler != None:
             logger = logging.getLogger()
             logger.removeHandler(self.transmit_handler)
+            self.transmit_handler.close()
             del self.transmit_handler
 
     def disable_logging(self):
@@ -278,7 +348,7 @@ class LoggingCtl:
 
         return (file_debug, file_info)
 
-    def _create_export_handler(self, target: list, colours: bool = False):
+    def _create_export_handler(self, target, colours: bool = False):
         export_handler = ExportHandler(target)
         export_handler.setFormatter(MultilineFormatter(colours))
 
@@ -287,8 +357,8 @@ class LoggingCtl:
     def get_recipe_log_path(self):
         return self.recipe_log_path
 
-    def get_recipe_log_list(self):
-        return self.log_list
+    def get_recipe_log_store(self):
+        return self.log_store
 
     def set_origin_name(self, name):
         self._origin_name = name
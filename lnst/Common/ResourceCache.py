@@ -11,14 +11,16 @@ rpazdera@redhat.com (Radek Pazdera)
 
 import logging
 import os
+import re
 import time
 import shutil
 import json
+import tempfile
 from lnst.Common.Utils import sha256sum
 from lnst.Common.LnstError import LnstError
 
 #current index version
-INDEX_VERSION = 1
+INDEX_VERSION = 2
 #minimal supported index version -- will be updated to current one when loaded
 MIN_INDEX_VERSION = 1
 
@@ -26,11 +28,21 @@ class ResourceCacheError(LnstError):
     pass
 
 class ResourceCache(object):
+    """Persistent content addressed cache of files sent by the controller
+
+    Files are stored under their sha256 digest in the cache directory, the
+    index file keeps track of their names and last use. Entries are removed
+    when they were not used for longer than the expiration period or, least
+    recently used first, when the total size of the cache exceeds the size
+    limit. A size limit or expiration period of 0 disables the respective
+    check.
+    """
     _CACHE_INDEX_FILE_NAME = "index"
     _root = None
     _expiration_period = None
+    _size_limit = None
 
-    def __init__(self, cache_path, expiration_period):
+    def __init__(self, cache_path, expiration_period, size_limit=0):
         if os.path.exists(cache_path):
             if os.path.isdir(cache_path):
                 self._root = cache_path
@@ -42,34 +54,85 @@ class ResourceCache(object):
 
         self._index = {"index_version": INDEX_VERSION,
                        "entries": {}}
-        self._read_index()
         self._expiration_period = expiration_period
+        self._size_limit = size_limit
+        self._read_index()
 
     def _read_index(self):
+        if not os.path.exists(self.index_path):
+            self._rebuild_index()
+            return
+
         try:
-            with open(self.index_path, "w") as f:
+            with open(self.index_path, "r") as f:
                 index = json.load(f)
-                if index["index_version"] > INDEX_VERSION:
-                    raise ResourceCacheError("Incompatible ResourceCache index versions")
-                elif index["index_version"] == INDEX_VERSION:
-                    self._index = index
-                    logging.debug("Resource cache index loaded")
-                else:
-                    self._index = self._update_old_index(index)
-                    logging.debug("Resource cache index loaded")
-                    self._save_index()
-        except:
-            pass
+            if index["index_version"] > INDEX_VERSION:
+                raise ResourceCacheError("Incompatible ResourceCache index versions")
+            elif index["index_version"] < INDEX_VERSION:
+                index = self._update_old_index(index)
+            self._index = index
+        except (ValueError, KeyError, TypeError, OSError, ResourceCacheError) as e:
+            logging.warning("Resource cache index is unusable (%s), rebuilding it" % e)
+            self._rebuild_index()
+            return
+
+        # drop entries for files that disappeared from the cache directory
+        for entry_hash, entry in list(self._index["entries"].items()):
+            if not os.path.isfile(entry["path"]):
+                del self._index["entries"][entry_hash]
+        self._save_index()
+        logging.debug("Resource cache index loaded")
+
+    def _rebuild_index(self):
+        """Recreates the index from the files present in the cache directory
+
+        Only files named by the digest of their content are picked up,
+        leftovers of an interrupted index write are removed.
+        """
+        self._index = {"index_version": INDEX_VERSION,
+                       "entries": {}}
+        for file_name in os.listdir(self._root):
+            file_path = os.path.join(self._root, file_name)
+            if file_name == self._CACHE_INDEX_FILE_NAME or \
+               not os.path.isfile(file_path):
+                continue
+
+            if file_name.startswith(".index."):
+                os.remove(file_path)
+            elif re.match(r"^[0-9a-f]{64}$", file_name) and \
+                 sha256sum(file_path) == file_name:
+                self._index["entries"][file_name] = {
+                    "name": file_name,
+                    "path": file_path,
+                    "last_used": int(os.path.getmtime(file_path)),
+                    "digest": file_name,
+                    "size": os.path.getsize(file_path),
+                    "type": "file"}
+        self._save_index()
 
     def _update_old_index(self, old):
         if old["index_version"] < MIN_INDEX_VERSION:
             raise ResourceCacheError("ResourceCache index version too old to update")
         logging.debug("Updating old index to newer version")
+
+        if old["index_version"] < 2:
+            for entry in old["entries"].values():
+                entry["size"] = os.path.getsize(entry["path"]) \
+                    if os.path.isfile(entry["path"]) else 0
+        old["index_version"] = INDEX_VERSION
         return old
 
     def _save_index(self):
-        with open(self.index_path, "w") as f:
-            json.dump(self._index, f)
+        fd, tmp_path = tempfile.mkstemp(dir=self._root, prefix=".index.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._index, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+        except:
+            os.remove(tmp_path)
+            raise
 
     @property
     def index_path(self):
@@ -79,14 +142,26 @@ class ResourceCache(object):
     def root(self):
         return self._root
 
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self._index["entries"].values())
+
     def query(self, res_hash):
         return res_hash in self._index["entries"]
 
+    def query_many(self, res_hashes):
+        return [res_hash in self._index["entries"] for res_hash in res_hashes]
+
     def get_path(self, res_hash):
         return self._index["entries"][res_hash]["path"]
 
     def renew_entry(self, entry_hash):
-        self._index["entries"][entry_hash]["last_used"] = int(time.time())
+        self.renew_entries([entry_hash])
+
+    def renew_entries(self, entry_hashes):
+        now = int(time.time())
+        for entry_hash in entry_hashes:
+            self._index["entries"][entry_hash]["last_used"] = now
         self._save_index()
 
     def add_file_entry(self, filepath, entry_name):
@@ -105,28 +180,48 @@ class ResourceCache(object):
                  "path": entry_path,
                  "last_used": int(time.time()),
                  "digest": entry_hash,
+                 "size": os.path.getsize(entry_path),
                  "type": "file"}
         self._index["entries"][entry_hash] = entry
 
+        self._evict_entries(keep=entry_hash)
         self._save_index()
 
         return entry_hash
 
     def del_cache_entry(self, entry_hash):
         if entry_hash in self._index["entries"]:
-            os.remove(self._index["entries"][entry_hash].path)
-            del self._index["entries"][entry_hash]
+            self._remove_entry(entry_hash)
             self._save_index()
 
-    def del_old_entries(self):
-        if self._expiration_period == 0:
+    def _remove_entry(self, entry_hash):
+        try:
+            os.remove(self._index["entries"][entry_hash]["path"])
+        except FileNotFoundError:
+            pass
+        del self._index["entries"][entry_hash]
+
+    def _evict_entries(self, keep=None):
+        if not self._size_limit:
             return
 
-        rm = []
-        now = time.time()
-        for entry_hash, entry in list(self._index["entries"].items()):
-            if entry["last_used"] <= (now - self._expiration_period):
-                rm.append(entry_hash)
+        total = self.size
+        lru = sorted(self._index["entries"].values(),
+                     key=lambda entry: entry["last_used"])
+        for entry in lru:
+            if total <= self._size_limit:
+                break
+            if entry["digest"] == keep:
+                continue
+            total -= entry["size"]
+            self._remove_entry(entry["digest"])
 
-        for entry_hash in rm:
-            self.del_cache_entry(entry_hash)
+    def del_old_entries(self):
+        if self._expiration_period != 0:
+            now = time.time()
+            for entry_hash, entry in list(self._index["entries"].items()):
+                if entry["last_used"] <= (now - self._expiration_period):
+                    self._remove_entry(entry_hash)
+
+        self._evict_entries()
+        self._save_index()
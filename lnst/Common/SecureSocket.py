@@ -17,6 +17,7 @@ olichtne@redhat.com (Ondrej Lichtner)
 
 import os
 import pickle
+import struct
 import hashlib
 import hmac
 from lnst.Common.Utils import not_imported
@@ -75,11 +76,20 @@ if bit_length(SRP_GROUP["p"])%8:
 class SecSocketException(LnstError):
     pass
 
+# every message is sent as a single frame: a fixed size header with the payload
+# length, sequence number and flags followed by the payload, which is the
+# AES-GCM ciphertext and tag once the cipher spec is established
+FRAME_HEADER = struct.Struct("!IQB")
+FLAG_ENCRYPTED = 0x01
+FLAG_CONTROL = 0x02
+AEAD_TAG_SIZE = 16
+
+# minimal size of a single read from the socket
+RECV_CHUNK_SIZE = 256*1024
+
 cryptography = not_imported
 hashes = not_imported
-Cipher = not_imported
-algorithms = not_imported
-modes = not_imported
+AESGCM = not_imported
 padding = not_imported
 ec = not_imported
 EllipticCurvePrivateKey = not_imported
@@ -92,14 +102,12 @@ default_backend = not_imported
 cryptography_imported = not_imported
 def cryptography_imports():
     global cryptography_imported
-    if cryptography_imported:
+    if cryptography_imported is True:
         return
 
     global cryptography
     global hashes
-    global Cipher
-    global algorithms
-    global modes
+    global AESGCM
     global padding
     global ec
     global EllipticCurvePrivateKey
@@ -113,7 +121,7 @@ def cryptography_imports():
     try:
         import cryptography.exceptions
         from cryptography.hazmat.primitives import hashes
-        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
         from cryptography.hazmat.primitives.asymmetric import padding, ec
         from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePrivateKey
         from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicKey
@@ -137,21 +145,23 @@ class SecureSocket(object):
         self._ctl_random = None
         self._agent_random = None
 
-        self._current_write_spec = {"enc_key": None,
-                                    "mac_key": None,
-                                    "seq_num": 0}
-        self._current_read_spec = {"enc_key": None,
-                                   "mac_key": None,
-                                   "seq_num": 0}
-        self._next_write_spec = {"enc_key": None,
-                                 "mac_key": None,
-                                 "seq_num": 0}
-        self._next_read_spec = {"enc_key": None,
-                                "mac_key": None,
-                                "seq_num": 0}
+        self._current_write_spec = self._empty_cipher_spec()
+        self._current_read_spec = self._empty_cipher_spec()
+        self._next_write_spec = self._empty_cipher_spec()
+        self._next_read_spec = self._empty_cipher_spec()
+
+        self._recv_buf = bytearray()
+        self._recv_pos = 0
+        self._recv_end = 0
+
+    @staticmethod
+    def _empty_cipher_spec():
+        return {"enc_key": None,
+                "aead": None,
+                "seq_num": 0}
 
     def send_msg(self, msg):
-        pickled_msg = pickle.dumps(msg)
+        pickled_msg = pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
         return self.send(pickled_msg)
 
     def recv_msg(self):
@@ -161,170 +171,132 @@ class SecureSocket(object):
         msg = pickle.loads(pickled_msg)
         return msg
 
-    def _add_mac_sign(self, data):
-        if not self._current_write_spec["mac_key"]:
-            return data
-        cryptography_imports()
-
-        msg = (bytes(str(self._current_write_spec["seq_num"]).encode('ascii'))
-               + bytes(str(len(data)).encode('ascii'))
-               + data)
-        signature = hmac.new(self._current_write_spec["mac_key"],
-                             msg,
-                             hashlib.sha256)
-        signed_msg = {"data": data,
-                      "signature": signature.digest()}
-        return pickle.dumps(signed_msg)
-
-    def _del_mac_sign(self, signed_data):
-        if not self._current_read_spec["mac_key"]:
-            return signed_data
-        cryptography_imports()
-
-        signed_msg = pickle.loads(signed_data)
-        data = signed_msg["data"]
-        msg = (bytes(str(self._current_read_spec["seq_num"]).encode('ascii'))
-               + bytes(str(len(data)).encode('ascii'))
-               + data)
-
-        signature = hmac.new(self._current_read_spec["mac_key"],
-                             msg,
-                             hashlib.sha256)
-
-        if signature.digest() != signed_msg["signature"]:
-            return None
-        return data
-
-    def _add_padding(self, data):
-        if not self._current_write_spec["enc_key"]:
-            return data
-        cryptography_imports()
-
-        block_size = algorithms.AES.block_size//8
-        pad_length = block_size - (len(data) % block_size)
-        pad_char = bytes([pad_length])
-        padding = pad_length * pad_char
-
-        padded_data = data+padding
-        return padded_data
-
-    def _del_padding(self, data):
-        if not self._current_read_spec["enc_key"]:
-            return data
-        cryptography_imports()
-
-        pad_length = ord(data[-1])
-        for char in data[-pad_length]:
-            if ord(char) != pad_length:
-                return None
-
-        return data[:-pad_length]
-
-    def _add_encrypt(self, data):
-        if not self._current_write_spec["enc_key"]:
-            return data
-        cryptography_imports()
-
-        iv = os.urandom(algorithms.AES.block_size//8)
-        mode = modes.CBC(iv)
-        key = self._current_write_spec["enc_key"]
-        cipher = Cipher(algorithms.AES(key), mode, default_backend())
-        encryptor = cipher.encryptor()
+    @staticmethod
+    def _nonce(seq_num):
+        # the sequence number is unique for each message sent with a key and
+        # each direction uses a different key
+        return b"\x00\x00\x00\x00" + struct.pack("!Q", seq_num)
 
-        encrypted_data = encryptor.update(data) + encryptor.finalize()
+    def send(self, data, flags=0):
+        spec = self._current_write_spec
+        seq_num = spec["seq_num"]
 
-        encrypted_msg = {"iv": iv,
-                         "enc_data": encrypted_data}
-
-        return pickle.dumps(encrypted_msg)
-
-    def _del_encrypt(self, data):
-        if not self._current_read_spec["enc_key"]:
-            return data
-        cryptography_imports()
-
-        encrypted_msg = pickle.loads(data)
-        encrypted_data = encrypted_msg["enc_data"]
-
-        iv = encrypted_msg["iv"]
-        mode = modes.CBC(iv)
-        key = self._current_read_spec["enc_key"]
-        cipher = Cipher(algorithms.AES(key), mode, default_backend())
-        decryptor = cipher.decryptor()
-
-        decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
-
-        return decrypted_data
-
-    def _protect_data(self, data):
-        signed = self._add_mac_sign(data)
-        padded = self._add_padding(signed)
-        encrypted = self._add_encrypt(padded)
-
-        self._current_write_spec["seq_num"] += 1
-        return encrypted
-
-    def _uprotect_data(self, encrypted):
-        padded = self._del_encrypt(encrypted)
-        signed = self._del_padding(padded)
-
-        if signed is None:
-            #preventing timing attacks
-            self._del_mac_sign(padded)
-            return None
+        if spec["aead"] is not None:
+            flags |= FLAG_ENCRYPTED
+            header = FRAME_HEADER.pack(len(data) + AEAD_TAG_SIZE, seq_num, flags)
+            payload = spec["aead"].encrypt(self._nonce(seq_num), data, header)
+        else:
+            header = FRAME_HEADER.pack(len(data), seq_num, flags)
+            payload = data
+
+        spec["seq_num"] += 1
+        self._sendall([header, payload])
+
+    def _sendall(self, buffers):
+        buffers = [memoryview(buf) for buf in buffers]
+        while buffers:
+            sent = self._socket.sendmsg(buffers)
+            while sent > 0:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+    def _fill_recv_buffer(self, size):
+        """Reads from the socket until at least size bytes are buffered
+
+        Each read takes everything the socket has available (up to the free
+        space in the buffer), so multiple small frames are usually received
+        with a single syscall.
+        """
+        while self._recv_end - self._recv_pos < size:
+            buffered = self._recv_end - self._recv_pos
+            if len(self._recv_buf) - self._recv_pos < max(size, RECV_CHUNK_SIZE):
+                # move the buffered data to the start and make space for
+                # at least the requested size
+                self._recv_buf[:buffered] = \
+                    self._recv_buf[self._recv_pos:self._recv_end]
+                self._recv_pos = 0
+                self._recv_end = buffered
+                missing = max(size, RECV_CHUNK_SIZE) - len(self._recv_buf)
+                if missing > 0:
+                    self._recv_buf.extend(bytes(missing))
+
+            with memoryview(self._recv_buf) as view:
+                n = self._socket.recv_into(view[self._recv_end:])
+            if n == 0:
+                return False
+            self._recv_end += n
+        return True
 
-        data = self._del_mac_sign(signed)
+    def _consume_recv_buffer(self, size):
+        with memoryview(self._recv_buf) as view:
+            data = bytes(view[self._recv_pos:self._recv_pos + size])
+        self._recv_pos += size
 
-        self._current_read_spec["seq_num"] += 1
+        if self._recv_pos == self._recv_end:
+            self._recv_pos = self._recv_end = 0
+            if len(self._recv_buf) > 4 * RECV_CHUNK_SIZE:
+                # don't keep the memory used by a large message
+                self._recv_buf = bytearray(RECV_CHUNK_SIZE)
         return data
 
-    def send(self, data):
-        protected_data = self._protect_data(data)
-
-        transmit_data = bytes(str(len(protected_data)).encode('ascii')) + b" " + protected_data
-
-        return self._socket.sendall(transmit_data)
+    def has_buffered_msg(self):
+        """True if a complete frame was already read from the socket"""
+        buffered = self._recv_end - self._recv_pos
+        if buffered < FRAME_HEADER.size:
+            return False
+        length = FRAME_HEADER.unpack_from(self._recv_buf, self._recv_pos)[0]
+        return buffered >= FRAME_HEADER.size + length
 
     def recv(self):
-        length = b""
         while True:
-            c = self._socket.recv(1)
-
-            if c == b' ':
-                length = int(length.decode('ascii'))
-                break
-            elif c == b"":
+            if not self._fill_recv_buffer(FRAME_HEADER.size):
                 return b""
-            else:
-                length += c
+            length, seq_num, flags = FRAME_HEADER.unpack_from(self._recv_buf,
+                                                              self._recv_pos)
 
-        data = b""
-        while len(data) < length:
-            c = self._socket.recv(length - len(data))
-            if c == b"":
+            if not self._fill_recv_buffer(FRAME_HEADER.size + length):
                 return b""
+            header = self._consume_recv_buffer(FRAME_HEADER.size)
+            payload = self._consume_recv_buffer(length)
+
+            spec = self._current_read_spec
+            if seq_num != spec["seq_num"]:
+                raise SecSocketException("Unexpected message sequence number "
+                                         "{}, expected {}".format(
+                                             seq_num, spec["seq_num"]))
+
+            if spec["aead"] is not None:
+                if not flags & FLAG_ENCRYPTED:
+                    raise SecSocketException("Received an unencrypted message "
+                                             "on a secure channel")
+                try:
+                    data = spec["aead"].decrypt(self._nonce(seq_num),
+                                                payload, header)
+                except cryptography.exceptions.InvalidTag:
+                    raise SecSocketException("Message authentication failed")
             else:
-                data += c
+                data = payload
 
-        msg = self._uprotect_data(data)
-        if msg is None:
-            return self.recv()
-        return self._handle_internal(msg)
+            spec["seq_num"] += 1
 
-    def _handle_internal(self, orig_msg):
-        try:
-            msg = pickle.loads(orig_msg)
-        except:
-            return orig_msg
-        if "type" in msg and msg["type"] == "change_cipher_spec":
+            if flags & FLAG_CONTROL:
+                self._handle_control(pickle.loads(data))
+                continue
+            return data
+
+    def _handle_control(self, msg):
+        if msg["type"] == "change_cipher_spec":
             self._change_read_cipher_spec()
-            return self.recv()
         else:
-            return orig_msg
+            raise SecSocketException("Unknown control message")
 
     def _send_change_cipher_spec(self):
         change_cipher_spec_msg = {"type": "change_cipher_spec"}
-        self.send_msg(change_cipher_spec_msg)
+        self.send(pickle.dumps(change_cipher_spec_msg), FLAG_CONTROL)
         self._change_write_cipher_spec()
         return
 
@@ -344,16 +316,12 @@ class SecureSocket(object):
 
     def _change_read_cipher_spec(self):
         self._current_read_spec = self._next_read_spec
-        self._next_read_spec = {"enc_key": None,
-                                "mac_key": None,
-                                "seq_num": 0}
+        self._next_read_spec = self._empty_cipher_spec()
         return
 
     def _change_write_cipher_spec(self):
         self._current_write_spec = self._next_write_spec
-        self._next_write_spec = {"enc_key": None,
-                                 "mac_key": None,
-                                 "seq_num": 0}
+        self._next_write_spec = self._empty_cipher_spec()
         return
 
     def p_SHA256(self, secret, seed, length):
@@ -382,23 +350,18 @@ class SecureSocket(object):
             raise SecSocketException("Socket without a role!")
         cryptography_imports()
 
-        aes_keysize = max(algorithms.AES.key_sizes)//8
-        mac_keysize = hashlib.sha256().block_size
+        aes_keysize = 256//8
 
         prf_seq = self.PRF(self._master_secret,
-                           "key expansion",
+                           b"key expansion",
                            self._agent_random + self._ctl_random,
-                           2 * aes_keysize + 2 * mac_keysize)
+                           2 * aes_keysize)
 
         client_spec["enc_key"] = prf_seq[:aes_keysize]
+        client_spec["aead"] = AESGCM(client_spec["enc_key"])
         prf_seq = prf_seq[aes_keysize:]
         server_spec["enc_key"] = prf_seq[:aes_keysize]
-        prf_seq = prf_seq[aes_keysize:]
-
-        client_spec["mac_key"] = prf_seq[:mac_keysize]
-        prf_seq = prf_seq[mac_keysize:]
-        server_spec["mac_key"] = prf_seq[:mac_keysize]
-        prf_seq = prf_seq[mac_keysize:]
+        server_spec["aead"] = AESGCM(server_spec["enc_key"])
         return
 
     def _sign_data(self, data, privkey):
@@ -15,10 +15,12 @@ olichtne@redhat.com (Ondrej Lichtner)
 
 import logging
 import os
+import time
 import errno
 import re
 import socket
 import select
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from lnst.Common.NetUtils import normalize_hwaddr
 from lnst.Controller.Common import ControllerError
 from lnst.Controller.Machine import Machine
@@ -29,6 +31,31 @@ from lnst.Common.Utils import check_process_running
 class PoolManagerError(ControllerError):
     pass
 
+class AgentLivenessRegistry(object):
+    """Cache of agent reachability probe results
+
+    Shared by all AgentPoolManager instances of the controller process so
+    that creating another Controller object doesn't probe the same agents
+    again while the cached results are still valid.
+    """
+    def __init__(self):
+        self._results = {}
+
+    def get(self, hostname, port, ttl):
+        try:
+            available, checked_at = self._results[(hostname, port)]
+        except KeyError:
+            return None
+
+        if time.time() - checked_at > ttl:
+            return None
+        return available
+
+    def set(self, hostname, port, available):
+        self._results[(hostname, port)] = (available, time.time())
+
+liveness_registry = AgentLivenessRegistry()
+
 class AgentPoolManager(object):
     """
     This class is responsible for managing test machines that
@@ -74,11 +101,79 @@ class AgentPoolManager(object):
                 pool[m_id] = Machine(m_id, hostname, self._msg_dispatcher,
                                      ctl_config, libvirt_domain, rpc_port,
                                      m_spec["security"], params)
-                pool[m_id].init_connection()
                 #TODO check if all described devices are available
 
         logging.info("Finished loading pools.")
 
+    def connect_machines(self, machines):
+        """Initializes the connection to the machines selected by a match
+
+        Connecting to the agents is deferred until the machines are actually
+        needed, machines that are already connected are skipped.
+        """
+        machines = [machine for machine in machines
+                    if self._msg_dispatcher.get_connection(machine) is None]
+        self._init_connections(machines)
+
+    def _init_connections(self, machines):
+        """Connects to the machines concurrently
+
+        The TCP connection and security handshake run in a bounded thread
+        pool, the hello calls are then pipelined through the message
+        dispatcher. Machines that failed are reported together once all of
+        the connection attempts finished.
+        """
+        workers = self._ctl_config.get_option("environment",
+                                              "connection_workers")
+        # a timeout of 0 means waiting indefinitely
+        timeout = self._ctl_config.get_option("environment",
+                                              "connection_timeout") or None
+
+        if len(machines) == 0:
+            return
+
+        failed = {}
+        connections = {}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(machine.connect, timeout): machine
+                       for machine in machines}
+            for future in as_completed(futures):
+                machine = futures[future]
+                try:
+                    connections[machine] = future.result()
+                except Exception as exc:
+                    failed[machine] = exc
+
+        hellos = {}
+        for machine in machines:
+            if machine in connections:
+                machine.register_connection(connections[machine])
+                hellos[machine] = machine.send_hello()
+
+        deadline = time.time() + timeout if timeout else None
+        for machine, hello in hellos.items():
+            remaining = max(0, deadline - time.time()) if deadline else None
+            try:
+                machine.finish_init_connection(hello, remaining)
+            except Exception as exc:
+                failed[machine] = exc
+                self._msg_dispatcher.disconnect_agent(machine)
+
+        for machine in failed:
+            liveness_registry.set(machine.get_hostname(), machine.get_port(),
+                                  False)
+
+        if failed:
+            msg = "Unable to initialize connection to {} machine(s):\n{}".format(
+                len(failed),
+                "\n".join("    {} ({}): {}".format(
+                               machine.get_id(), machine.get_hostname(),
+                               exc if str(exc) else type(exc).__name__)
+                           for machine in machines if machine in failed
+                           for exc in [failed[machine]])
+            )
+            raise PoolManagerError(msg)
+
     def get_pools(self):
         return self._pools
 
@@ -120,6 +215,9 @@ class AgentPoolManager(object):
                 max_len = len(m_id)
 
         if self._pool_checks:
+            ttl = self._ctl_config.get_option("environment", "liveness_ttl")
+            timeout = self._ctl_config.get_option("environment",
+                                                  "connection_timeout") or None
             check_sockets = {}
             for m_id, m in sorted(pool.items()):
                 hostname = m["params"]["hostname"]
@@ -128,6 +226,13 @@ class AgentPoolManager(object):
                 else:
                     port = self._ctl_config.get_option('environment', 'rpcport')
 
+                available = liveness_registry.get(hostname, port, ttl)
+                if available is not None:
+                    pool[m_id]["available"] = available
+                    logging.debug("Using cached state of machine '%s': %s:%s" %\
+                                                    (m_id, hostname, port))
+                    continue
+
                 logging.debug("Querying machine '%s': %s:%s" %\
                                                 (m_id, hostname, port))
 
@@ -145,18 +250,29 @@ class AgentPoolManager(object):
 
                     if en != errno.EINPROGRESS:
                         pool[m_id]["available"] = False
+                        liveness_registry.set(hostname, port, False)
                         s.close()
                         logging.debug("Bypassing machine '%s' (%s)" %
                             (m_id, msg))
                         continue
 
-                check_sockets[s] = m_id
+                check_sockets[s] = (m_id, hostname, port)
 
+            deadline = time.time() + timeout if timeout else None
             while len(check_sockets) > 0:
-                rl, wl, el = select.select([], list(check_sockets.keys()), [])
+                remaining = max(0, deadline - time.time()) if deadline else None
+                rl, wl, el = select.select([], list(check_sockets.keys()), [],
+                                           remaining)
+                if len(wl) == 0:
+                    for s, (m_id, hostname, port) in check_sockets.items():
+                        logging.debug("Machine '%s' probe timed out" % m_id)
+                        pool[m_id]["available"] = False
+                        s.close()
+                    check_sockets = {}
+
                 for s in wl:
                     err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
-                    m_id = check_sockets[s]
+                    m_id, hostname, port = check_sockets[s]
                     if err == 0:
                         pool[m_id]["available"] = True
                         s.shutdown(socket.SHUT_RDWR)
@@ -166,6 +282,8 @@ class AgentPoolManager(object):
                         pool[m_id]["available"] = False
                         s.close()
                         del check_sockets[s]
+                    liveness_registry.set(hostname, port,
+                                          pool[m_id]["available"])
         else:
             for m_id in list(pool.keys()):
                 pool[m_id]["available"] = True
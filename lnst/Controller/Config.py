@@ -62,6 +62,33 @@ class CtlConfig(Config):
                 "name" : "allow_virtual"
                 }
 
+        self._options['environment']['connection_workers'] = {
+                "value" : 16,
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "connection_workers"
+                }
+        self._options['environment']['connection_timeout'] = {
+                "value" : 60,
+                "additive" : False,
+                "action" : self.optionTimeval,
+                "name" : "connection_timeout"
+                }
+
+        self._options['environment']['liveness_ttl'] = {
+                "value" : 60,
+                "additive" : False,
+                "action" : self.optionTimeval,
+                "name" : "liveness_ttl"
+                }
+
+        self._options['environment']['run_archive'] = {
+                "value" : False,
+                "additive" : False,
+                "action" : self.optionBool,
+                "name" : "run_archive"
+                }
+
         self._options['pools'] = dict()
 
         self._options['security'] = dict()
@@ -108,6 +108,10 @@ class ContainerPoolManager(object):
     def get_machine_pool(self, pool_name):
         return self._machines
 
+    def connect_machines(self, machines):
+        # containers are connected to when they're created in process_reqs
+        pass
+
     def get_networks(self):
         return self._networks
 
@@ -13,7 +13,9 @@ import sys
 from typing import Union
 import datetime
 import logging
-from lnst.Common.Logs import LoggingCtl, log_exc_traceback
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from lnst.Common.Logs import LoggingCtl, ThreadLogCapture, log_exc_traceback
 from lnst.Common.NetUtils import MacPool
 from lnst.Common.Utils import mkdir_p
 from lnst.Devices.VirtualDevice import VirtualDevice
@@ -25,7 +27,7 @@ from lnst.Controller.ContainerPoolManager import ContainerPoolManager
 from lnst.Controller.MachineMapper import MachineMapper
 from lnst.Controller.MachineMapper import format_match_description
 from lnst.Controller.Host import Hosts, Host
-from lnst.Controller.Recipe import BaseRecipe, RecipeRun
+from lnst.Controller.Recipe import BaseRecipe, RecipeRun, default_run_archive_name
 from lnst.Controller.RecipeControl import RecipeControl
 
 class Controller(object):
@@ -168,8 +170,12 @@ class Controller(object):
                     logging.info(line)
                 try:
                     self._map_match(match, req, recipe)
-                    recipe._init_run(RecipeRun(recipe, match, log_dir=self._log_ctl.get_recipe_log_path(),
-                                               log_list=self._log_ctl.get_recipe_log_list()))
+                    run = RecipeRun(recipe, match, log_dir=self._log_ctl.get_recipe_log_path(),
+                                    log_store=self._log_ctl.get_recipe_log_store())
+                    recipe._init_run(run)
+                    if self._config.get_option("environment", "run_archive"):
+                        run.start_archive(os.path.join(
+                            run.log_dir, default_run_archive_name(run)))
                     recipe.test()
                 except Exception as exc:
                     if recipe.current_run:
@@ -179,6 +185,8 @@ class Controller(object):
                     raise
                 finally:
                     self._cleanup_agents()
+                    if recipe.current_run:
+                        recipe.current_run.finish_archive()
                     self._log_ctl.unset_recipe()
         finally:
             if isinstance(self._pools, ContainerPoolManager):
@@ -188,16 +196,27 @@ class Controller(object):
         self._machines = {}
         self._hosts = Hosts()
         pool = self._pools.get_machine_pool(match["pool_name"])
+        self._pools.connect_machines(
+            [pool[m["target"]] for m in match["machines"].values()]
+        )
         for m_id, m in list(match["machines"].items()):
             machine = self._machines[m_id] = pool[m["target"]]
 
             setattr(self._hosts, m_id, Host(machine))
-            host = getattr(self._hosts, m_id)
 
             machine.set_id(m_id)
             machine.set_mapped(True)
-            self._prepare_machine(machine)
+            self._log_ctl.add_agent(machine.get_id())
+            machine.set_mac_pool(self._mac_pool)
+            machine.set_network_bridges(self._network_bridges)
 
+        self._raise_machine_errors(
+            "preparation",
+            self._run_on_machines(self._prepare_machine, self._machines),
+        )
+
+        for m_id, m in list(match["machines"].items()):
+            host = getattr(self._hosts, m_id)
             for if_id, i in list(m["interfaces"].items()):
                 host.map_device(if_id, i)
 
@@ -210,34 +229,90 @@ class Controller(object):
                     setattr(host, name, new_virt_dev)
                     new_virt_dev._enable()
 
-            machine.start_recipe(recipe)
+        self._raise_machine_errors(
+            "start_recipe",
+            self._run_on_machines(
+                lambda machine: machine.start_recipe(recipe), self._machines
+            ),
+        )
 
     def _prepare_machine(self, machine):
-        self._log_ctl.add_agent(machine.get_id())
-        machine.set_mac_pool(self._mac_pool)
-        machine.set_network_bridges(self._network_bridges)
-
         machine.prepare_machine()
 
+    def _run_on_machines(self, func, machines):
+        """Calls func(machine) for all the machines concurrently
+
+        The RPC calls of the individual machines are handled by the
+        MessageDispatcher in parallel. Controller log messages of each
+        machine are held back and logged per machine, in the order of the
+        machines dictionary, once all of them are finished.
+
+        Returns a list of (machine id, exception) tuples of the machines where
+        func failed, in the same order.
+        """
+        if len(machines) <= 1:
+            errors = []
+            for m_id, machine in machines.items():
+                try:
+                    func(machine)
+                except Exception as exc:
+                    errors.append((m_id, exc))
+            return errors
+
+        def run(machine, records):
+            capture.capture_thread(records)
+            try:
+                func(machine)
+            finally:
+                capture.release_thread()
+
+        records = {m_id: [] for m_id in machines}
+        with ThreadLogCapture() as capture, \
+             ThreadPoolExecutor(max_workers=len(machines)) as executor:
+            futures = {m_id: executor.submit(run, machine, records[m_id])
+                       for m_id, machine in machines.items()}
+            wait(futures.values())
+
+        errors = []
+        for m_id, future in futures.items():
+            ThreadLogCapture.emit_records(records[m_id])
+            if future.exception() is not None:
+                errors.append((m_id, future.exception()))
+        return errors
+
+    def _raise_machine_errors(self, action, errors):
+        if not errors:
+            return
+
+        if len(errors) == 1:
+            raise errors[0][1]
+
+        msg = "Machine {} failed on {} machines:\n{}".format(
+            action,
+            len(errors),
+            "\n".join("{}: {}".format(m_id, exc) for m_id, exc in errors),
+        )
+        raise ControllerError(msg) from errors[0][1]
+
     def _cleanup_agents(self):
         if self._machines == None:
             return
 
+        errors = self._run_on_machines(lambda machine: machine.cleanup(),
+                                       self._machines)
+        for m_id, exc in errors:
+            #TODO report errors during deconfiguration as FAIL!!
+            logging.debug("".join(traceback.format_exception(exc)))
+
         for m_id, machine in list(self._machines.items()):
-            try:
-                machine.cleanup()
-            except:
-                #TODO report errors during deconfiguration as FAIL!!
-                log_exc_traceback()
-            finally:
-                machine.stop_recipe()
-                for dev in list(machine._device_database.values()):
-                    if isinstance(dev, VirtualDevice):
-                        dev._destroy()
-
-                #clean-up agent logger
-                self._log_ctl.remove_agent(m_id)
-                machine.set_mapped(False)
+            machine.stop_recipe()
+            for dev in list(machine._device_database.values()):
+                if isinstance(dev, VirtualDevice):
+                    dev._destroy()
+
+            #clean-up agent logger
+            self._log_ctl.remove_agent(m_id)
+            machine.set_mapped(False)
 
         self._machines.clear()
 
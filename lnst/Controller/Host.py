@@ -56,6 +56,20 @@ class Host(Namespace):
                 ret.append(x)
         return ret
 
+    def batch(self):
+        """Context manager queueing device configuration on this host
+
+        Device attribute assignments and method calls made inside the with
+        block are sent to the agent in a single message when the block exits
+        instead of one round trip each. Example::
+
+            with host.batch():
+                for dev in host.devices:
+                    dev.mtu = 9000
+                    dev.up()
+        """
+        return self._machine.batch()
+
     def map_device(self, dev_id, how):
         if "hwaddr" in how:
             hwaddr = how["hwaddr"]
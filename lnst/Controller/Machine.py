@@ -11,9 +11,15 @@ __author__ = """
 rpazdera@redhat.com (Radek Pazdera)
 """
 
+import os
+import hashlib
 import logging
 import socket
 import sys
+import tarfile
+import tempfile
+from collections import deque
+from contextlib import contextmanager
 from lnst.Common.Utils import sha256sum
 from lnst.Common.Utils import check_process_running
 from lnst.Common.Version import lnst_version
@@ -30,6 +36,23 @@ from lnst.Devices.LoopbackDevice import LoopbackDevice
 if check_process_running("libvirtd"):
     from lnst.Controller.VirtDomainCtl import VirtDomainCtl
 
+# file transfers are split into chunks of this size, the number of chunks
+# sent without waiting for the agent's reply is limited by the window
+_COPY_CHUNK_SIZE = 1024*1024
+_COPY_WINDOW = 8
+
+_digest_cache = {}
+
+def _file_digest(file_path):
+    """sha256sum of the file, cached for as long as the file is unchanged"""
+    st = os.stat(file_path)
+    key = (file_path, st.st_mtime_ns, st.st_size)
+    try:
+        return _digest_cache[key]
+    except KeyError:
+        digest = _digest_cache[key] = sha256sum(file_path)
+        return digest
+
 class MachineError(ControllerError):
     pass
 
@@ -86,6 +109,7 @@ class Machine(object):
         self._device_database = {}
         self._tmp_device_database = []
         self._netns_moved_devices = {}
+        self._dev_batch = None
 
         self._initns = None
 
@@ -170,7 +194,88 @@ class Machine(object):
             "new_ifindex": None,
         }
 
+    @contextmanager
+    def batch(self):
+        """Context manager that queues remote device configuration
+
+        Device method calls and attribute assignments issued inside the block
+        are not sent immediately, they're shipped to the agent as a single
+        "dev_batch" call per namespace when the block exits. Reading a device
+        attribute flushes the queued operations first so that it always
+        returns an up to date value. Nested blocks are merged into the
+        outermost one.
+
+        If any of the queued operations fails the first exception is raised
+        after all of the operation results have been recorded.
+        """
+        if self._dev_batch is not None:
+            yield
+            return
+
+        self._dev_batch = []
+        try:
+            yield
+            self.flush_batch()
+        finally:
+            self._dev_batch = None
+
+    def flush_batch(self):
+        if not self._dev_batch:
+            return
+
+        ops, self._dev_batch = self._dev_batch, []
+
+        netns_groups = []
+        for op in ops:
+            for netns, group in netns_groups:
+                if netns is op["netns"]:
+                    group.append(op)
+                    break
+            else:
+                netns_groups.append((op["netns"], [op]))
+
+        pending = []
+        for netns, group in netns_groups:
+            batch = [op["data"] for op in group]
+            pending.append((group, self.rpc_call_async("dev_batch", batch,
+                                                       netns=netns)))
+
+        for group, future in pending:
+            for op, op_res in zip(group, future.result()):
+                op["response"] = op_res
+
+        first_exc = None
+        for op in ops:
+            config_res = op["config_res"]
+            if op["data"]["op"] == "setattr":
+                config_res._old_value = op["response"].get("old_value")
+
+            if op["response"]["exception"] is not None:
+                config_res.result = ResultType.FAIL
+                if first_exc is None:
+                    first_exc = op["response"]["exception"]
+            self._add_recipe_result(config_res)
+
+        if first_exc is not None:
+            raise first_exc
+
     def remote_device_method(self, index, method_name, args, kwargs, netns):
+        if self._dev_batch is not None:
+            config_res = DeviceMethodCallResult(
+                result=ResultType.PASS,
+                device=self._get_device_from_database(index, netns),
+                method_name=method_name,
+                args=args,
+                kwargs=kwargs,
+            )
+            self._dev_batch.append({
+                "netns": netns,
+                "config_res": config_res,
+                "data": {"op": "method", "ifindex": index, "name": method_name,
+                         "args": args, "kwargs": kwargs},
+            })
+            return None
+
         config_res = DeviceMethodCallResult(
             result=ResultType.PASS,
             device=self._get_device_from_database(index, netns),
@@ -190,6 +295,22 @@ class Machine(object):
         return res
 
     def remote_device_setattr(self, index, attr_name, value, netns):
+        if self._dev_batch is not None:
+            config_res = DeviceAttrSetResult(
+                result=ResultType.PASS,
+                device=self._get_device_from_database(index, netns),
+                attr_name=attr_name,
+                value=value,
+                old_value=None,
+            )
+            self._dev_batch.append({
+                "netns": netns,
+                "config_res": config_res,
+                "data": {"op": "setattr", "ifindex": index, "name": attr_name,
+                         "value": value},
+            })
+            return None
+
         config_res = DeviceAttrSetResult(
             result=ResultType.PASS,
             device=self._get_device_from_database(index, netns),
@@ -210,6 +331,7 @@ class Machine(object):
         return res
 
     def remote_device_getattr(self, index, attr_name, netns):
+        self.flush_batch()
         return self.rpc_call("dev_getattr", index, attr_name, netns=netns)
 
     def device_created(self, dev_data, netns=None):
@@ -320,6 +442,19 @@ class Machine(object):
         return None
 
     def rpc_call(self, method_name, *args, **kwargs):
+        return self.rpc_call_async(method_name, *args, **kwargs).result()
+
+    def rpc_call_async(self, method_name, *args, **kwargs):
+        """Sends the RPC call to the agent without waiting for the result
+
+        Multiple calls can be issued back to back, to the same or to different
+        agents, and their results collected later, which saves a full round
+        trip per call.
+
+        Returns an :py:class:`lnst.Controller.MessageDispatcher.RpcFuture`,
+        exceptions raised by the remote method are raised by its result()
+        method.
+        """
         if kwargs.get("netns") in self._namespaces.values():
             netns = kwargs["netns"]
             del kwargs["netns"]
@@ -337,7 +472,7 @@ class Machine(object):
                    "args": args,
                    "kwargs": kwargs}
 
-        return self._msg_dispatcher.send_message(self, msg)
+        return self._msg_dispatcher.send_message_async(self, msg)
 
     def init_connection(self, timeout=None):
         """ Initialize the agent connection
@@ -345,18 +480,41 @@ class Machine(object):
         This will connect to the Agent, get it's description (should be
         usable for matching), and checks version compatibility
         """
+        connection = self.connect(timeout)
+        self.register_connection(connection)
+        self.finish_init_connection(self.send_hello(), timeout)
+
+    def connect(self, timeout=None):
+        """Opens the connection to the Agent and runs the security handshake
+
+        Doesn't touch the message dispatcher so it's safe to call for
+        multiple machines from different threads.
+        """
         hostname = self._hostname
         port = self._port
         m_id = self._id
 
         logging.info("Connecting to RPC on machine %s (%s)", m_id, hostname)
-        connection = CtlSecSocket(socket.create_connection((hostname, port),
-                                                           timeout))
-        connection.handshake(self._security)
+        soc = socket.create_connection((hostname, port), timeout)
+        connection = CtlSecSocket(soc)
+        try:
+            connection.handshake(self._security)
+        except:
+            connection.close()
+            raise
+        soc.settimeout(None)
+        return connection
 
+    def register_connection(self, connection):
         self._msg_dispatcher.add_agent(self, connection)
 
-        hello, agent_desc = self.rpc_call("hello")
+    def send_hello(self):
+        return self.rpc_call_async("hello")
+
+    def finish_init_connection(self, hello_future, timeout=None):
+        hostname = self._hostname
+
+        hello, agent_desc = hello_future.result(timeout)
         if hello != "hello":
             msg = "Unable to establish RPC connection " \
                   "to machine %s, handshake failed!" % hostname
@@ -403,31 +561,47 @@ class Machine(object):
             self._recipe.current_run.add_result(result)
 
     def _send_device_classes(self):
-        for cls_name, cls in device_classes:
-            self.send_class(cls)
+        self.send_classes([cls for cls_name, cls in device_classes])
 
-        for cls_name, cls in device_classes:
-            module_name = cls.__module__
-            self.rpc_call("map_device_class", cls_name, module_name)
+        self.rpc_call("map_device_classes",
+                      [(cls_name, cls.__module__)
+                       for cls_name, cls in device_classes])
 
     def send_class(self, cls, netns=None):
-        classes = [cls]
-        classes.extend(self._get_base_classes(cls))
+        self.send_classes([cls], netns=netns)
 
-        for cls in reversed(classes):
-            module_name = cls.__module__
+    def send_classes(self, classes, netns=None):
+        """Makes the classes and all of their base classes available on the agent
 
-            if module_name == "builtins":
-                continue
+        A manifest of all the needed modules is synced with the agent's
+        resource cache at once and the modules are then loaded with a single
+        call, base class modules first.
+        """
+        modules = []
+        for cls in classes:
+            cls_chain = [cls]
+            cls_chain.extend(self._get_base_classes(cls))
+
+            for cls in reversed(cls_chain):
+                module_name = cls.__module__
+
+                if module_name == "builtins":
+                    continue
 
-            module = sys.modules[module_name]
-            filename = module.__file__
+                module = sys.modules[module_name]
+                filename = module.__file__
 
-            if filename[-3:] == "pyc":
-                filename = filename[:-1]
+                if filename[-3:] == "pyc":
+                    filename = filename[:-1]
 
-            res_hash = self.sync_resource(module_name, filename, netns=netns)
-            self.rpc_call("load_cached_module", module_name, res_hash, netns=netns)
+                if (module_name, filename) not in modules:
+                    modules.append((module_name, filename))
+
+        res_hashes = self.sync_resources(modules, netns=netns)
+        self.rpc_call("load_cached_modules",
+                      [(module_name, res_hash)
+                       for (module_name, _), res_hash in zip(modules, res_hashes)],
+                      netns=netns)
 
     def is_git_version(self, version):
         try:
@@ -460,7 +634,8 @@ class Machine(object):
         dev.enable_readonly_cache()
 
     def _set_readonly_cache_for_all_devices(self, netns):
-        for dev in self._device_database[netns].values():
+        # device messages of the agent may be processed by another thread
+        for dev in list(self._device_database[netns].values()):
             dev.enable_readonly_cache()
 
     def cleanup(self):
@@ -579,6 +754,9 @@ class Machine(object):
         """
         return self._hostname
 
+    def get_port(self):
+        return self._port
+
     def get_libvirt_domain(self):
         return self._libvirt_domain
 
@@ -631,52 +809,117 @@ class Machine(object):
             self.rpc_call("stop_packet_capture", netns=netns)
 
     def copy_file_to_machine(self, local_path, remote_path=None, netns=None):
+        """Streams the file to the agent
+
+        Up to _COPY_WINDOW chunks are in flight at the same time instead of
+        waiting for a round trip after each one, the agent verifies the
+        sha256 digest of the received data when the transfer is finished.
+        """
         remote_path = self.rpc_call("start_copy_to", remote_path, netns=netns)
 
-        f = open(local_path, "rb")
+        sha256 = hashlib.sha256()
+        in_flight = deque()
+        with open(local_path, "rb") as f:
+            while True:
+                data: bytes = f.read(_COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                sha256.update(data)
 
-        while True:
-            data: bytes = f.read(1024*1024) # 1MB buffer
-            if not data:
-                break
+                in_flight.append(self.rpc_call_async("copy_part_to",
+                                                     remote_path, data,
+                                                     netns=netns))
+                if len(in_flight) >= _COPY_WINDOW:
+                    in_flight.popleft().result()
 
-            self.rpc_call("copy_part_to", remote_path, data, netns=netns)
+        while in_flight:
+            in_flight.popleft().result()
 
-        self.rpc_call("finish_copy_to", remote_path, netns=netns)
+        self.rpc_call("finish_copy_to", remote_path, sha256.hexdigest(),
+                      netns=netns)
 
         return remote_path
 
     def copy_file_from_machine(self, remote_path, local_path):
+        """Streams the file from the agent
+
+        Keeps up to _COPY_WINDOW chunk requests in flight and checks the
+        sha256 digest of the received data against the one the agent computed
+        while sending it.
+        """
         status = self.rpc_call("start_copy_from", remote_path)
         if not status:
             raise MachineError("The requested file cannot be transfered." \
                        "It does not exist on machine %s" % self.get_id())
 
-        local_file = open(local_path, "wb")
+        sha256 = hashlib.sha256()
+        in_flight = deque()
+        with open(local_path, "wb") as local_file:
+            for _ in range(_COPY_WINDOW):
+                in_flight.append(self.rpc_call_async("copy_part_from",
+                                                     remote_path,
+                                                     _COPY_CHUNK_SIZE))
+            while in_flight:
+                data: bytes = in_flight.popleft().result()
+                if not data:
+                    continue
+                local_file.write(data)
+                sha256.update(data)
+                in_flight.append(self.rpc_call_async("copy_part_from",
+                                                     remote_path,
+                                                     _COPY_CHUNK_SIZE))
+
+        remote_digest = self.rpc_call("finish_copy_from", remote_path)
+        if remote_digest != sha256.hexdigest():
+            raise MachineError("Transfer of file %s from machine %s failed, "
+                               "sha256 mismatch" % (remote_path, self.get_id()))
 
-        buf_size = 1024*1024 # 1MB buffer
-        while True:
-            data: bytes = self.rpc_call("copy_part_from", remote_path, buf_size)
-            if not data:
-                break
-            local_file.write(data)
+    def sync_resource(self, res_name, file_path, netns=None):
+        return self.sync_resources([(res_name, file_path)], netns=netns)[0]
 
-        local_file.close()
-        self.rpc_call("finish_copy_from", remote_path)
+    def sync_resources(self, resources, netns=None):
+        """Makes sure the files are present in the agent's resource cache
 
-    def sync_resource(self, res_name, file_path, netns=None):
-        digest = sha256sum(file_path)
+        :param resources: list of (resource name, local file path) tuples
+        :return: list of digests of the resources, in the same order
+
+        The agent is asked about all of the digests in a single call, only the
+        files it doesn't have cached yet are transferred.
+        """
+        digests = [_file_digest(file_path) for _, file_path in resources]
+        present = self.rpc_call("has_resources", digests, netns=netns)
+
+        missing = {}
+        for (res_name, file_path), digest, is_present in zip(resources, digests,
+                                                             present):
+            if is_present or digest in missing:
+                continue
 
-        if not self.rpc_call("has_resource", digest, netns=netns):
             msg = "Transfering %s to machine %s as '%s'" % (file_path,
                                                             self.get_id(),
                                                             res_name)
             logging.debug(msg)
+            missing[digest] = (res_name, file_path)
 
+        if len(missing) == 1:
+            res_name, file_path = list(missing.values())[0]
             remote_path = self.copy_file_to_machine(file_path, netns=netns)
             self.rpc_call("add_resource_to_cache",
                            "file", remote_path, res_name, netns=netns)
-        return digest
+        elif len(missing) > 1:
+            with tempfile.NamedTemporaryFile(suffix=".tar") as archive:
+                with tarfile.open(fileobj=archive, mode="w") as tar:
+                    for digest, (res_name, file_path) in missing.items():
+                        tar.add(file_path, arcname=digest)
+                archive.flush()
+
+                remote_path = self.copy_file_to_machine(archive.name,
+                                                        netns=netns)
+            self.rpc_call("add_resource_archive_to_cache", remote_path,
+                          {digest: res_name
+                           for digest, (res_name, _) in missing.items()},
+                          netns=netns)
+        return digests
 
     def init_remote_class(self, cls, *args, **kwargs):
         module_name = cls.__module__
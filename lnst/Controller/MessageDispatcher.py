@@ -14,11 +14,16 @@ __author__ = """
 olichtne@redhat.com (Ondrej Lichtner)
 """
 
+import time
 import logging
 import copy
 import signal
+import threading
+from collections import deque
+from concurrent.futures import Future
 from lnst.Common.ConnectionHandler import send_data
 from lnst.Common.ConnectionHandler import ConnectionHandler
+from lnst.Common.LoggingHandler import unpack_log_batch
 from lnst.Common.Parameters import Parameters
 from lnst.Common.DeviceRef import DeviceRef
 from lnst.Controller.Common import ControllerError
@@ -93,47 +98,143 @@ def _timeout_handler(signum, frame):
     msg = "Timeout expired"
     raise WaitTimeoutError(msg)
 
+class RpcFuture(Future):
+    """Future representing the result of an RPC call sent to an Agent
+
+    Calling result() or exception() keeps processing incoming messages from
+    all agents until the result of this call arrives, so no separate thread
+    is needed for receiving.
+    """
+    def __init__(self, msg_dispatcher, machine, request_id, netns=None):
+        super(RpcFuture, self).__init__()
+        self._msg_dispatcher = msg_dispatcher
+        self.machine = machine
+        self.request_id = request_id
+        self.netns = netns
+
+    def result(self, timeout=None):
+        self._msg_dispatcher.wait_for_future(self, timeout)
+        return super(RpcFuture, self).result(timeout=0)
+
+    def exception(self, timeout=None):
+        self._msg_dispatcher.wait_for_future(self, timeout)
+        return super(RpcFuture, self).exception(timeout=0)
+
 class MessageDispatcher(ConnectionHandler):
     def __init__(self, log_ctl):
         super(MessageDispatcher, self).__init__()
         self._log_ctl = log_ctl
         self._machines = dict()
 
+        self._request_id_seq = 0
+        self._pending_requests = {}
+        self._pending_by_machine = {}
+
+        # RPC calls can be made from multiple threads, only one of them
+        # receives and processes messages at a time while the others wait for
+        # their results to be set
+        self._lock = threading.RLock()
+        self._received = threading.Condition()
+        self._receiver = None
+
     def add_agent(self, machine, connection):
         self._machines[machine] = machine
+        self._pending_by_machine[machine] = deque()
         self.add_connection(machine, connection)
 
     def send_message(self, machine, data):
+        return self.send_message_async(machine, data).result()
+
+    def send_message_async(self, machine, data):
+        """Sends a command message to the agent without waiting for the result
+
+        The message is tagged with a request id which the agent includes in
+        the result message so that any number of calls can be in flight at
+        the same time, to one or to several agents.
+
+        Returns an RpcFuture object.
+        """
         soc = self.get_connection(machine)
         data = remote_device_to_deviceref(data)
 
+        with self._lock:
+            self._request_id_seq += 1
+            request_id = self._request_id_seq
+
+            future = RpcFuture(self, machine, request_id, data.get("netns", None))
+            # registered before sending, another thread may receive the result
+            self._pending_requests[request_id] = future
+            self._pending_by_machine[machine].append(request_id)
+
+        if data["type"] == "to_netns":
+            data["data"]["request_id"] = request_id
+        else:
+            data["request_id"] = request_id
+
         if send_data(soc, data) == False:
+            with self._lock:
+                self._pending_requests.pop(request_id, None)
+                try:
+                    self._pending_by_machine[machine].remove(request_id)
+                except ValueError:
+                    pass
             msg = "Connection error from agent %s" % machine.get_id()
             raise ConnectionError(msg)
 
-        result = None
-        while True:
-            connected_agents = list(self._connection_mapping.keys())
-
-            messages = self.check_connections()
-            for msg in messages:
-                if msg[1]["type"] == "result" and msg[0] == machine:
-                    if result is not None:
-                        msg = ("Multiple result messages from the same agent "
-                               "'{}'".format(machine.get_id()))
-                        raise ConnectionError(msg)
-                    result = msg[1]
-                else:
-                    self._process_message(msg)
-
-            remaining_agents = list(self._connection_mapping.keys())
-            if connected_agents != remaining_agents:
-                self._handle_disconnects(set(connected_agents)-
-                                         set(remaining_agents))
-
-            if result is not None:
-                netns = data.get("netns", None)
-                return deviceref_to_remote_device(machine, result["result"], netns)
+        return future
+
+    def wait_for_future(self, future, timeout=None):
+        end_time = None if timeout is None else time.time() + timeout
+        while not future.done():
+            remaining = None
+            if end_time is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+
+            thread = threading.get_ident()
+            with self._received:
+                if self._receiver not in [None, thread]:
+                    if not future.done():
+                        self._received.wait(timeout=remaining)
+                    continue
+                # nested calls from message processing keep receiving
+                outer = self._receiver is None
+                self._receiver = thread
+
+            try:
+                if not future.done():
+                    self.handle_messages(timeout=remaining)
+            finally:
+                if outer:
+                    with self._received:
+                        self._receiver = None
+                        self._received.notify_all()
+
+    def _pop_pending_request(self, machine, request_id):
+        with self._lock:
+            pending = self._pending_by_machine.get(machine, deque())
+            if request_id is None:
+                # agent not tagging results, these are sent in order
+                try:
+                    request_id = pending[0]
+                except IndexError:
+                    return None
+
+            try:
+                pending.remove(request_id)
+            except ValueError:
+                pass
+            return self._pending_requests.pop(request_id, None)
+
+    def _fail_pending_requests(self, machine, exc):
+        with self._lock:
+            futures = [self._pending_requests.pop(request_id)
+                       for request_id in self._pending_by_machine.get(machine, [])]
+            self._pending_by_machine[machine] = deque()
+
+        for future in futures:
+            future.set_exception(exc)
 
     def wait_for_condition(self, condition_check, timeout=0):
         res = True
@@ -178,13 +279,16 @@ class MessageDispatcher(ConnectionHandler):
 
         return res
 
-    def handle_messages(self):
+    def handle_messages(self, timeout=None):
         connected_agents = list(self._connection_mapping.keys())
 
-        messages = self.check_connections()
+        messages = self.check_connections(timeout=timeout)
 
         for msg in messages:
             self._process_message(msg)
+            if msg[1]["type"] in ["result", "exception"]:
+                with self._received:
+                    self._received.notify_all()
 
         remaining_agents = list(self._connection_mapping.keys())
         if connected_agents != remaining_agents:
@@ -196,9 +300,22 @@ class MessageDispatcher(ConnectionHandler):
         if message[1]["type"] == "log":
             record = message[1]["record"]
             self._log_ctl.add_client_log(message[0].get_id(), record)
+        elif message[1]["type"] == "log_batch":
+            agent_id = message[0].get_id()
+            for record in unpack_log_batch(message[1]["records"]):
+                self._log_ctl.add_client_log(agent_id, record)
         elif message[1]["type"] == "result":
-            msg = "Received result message from different agent %s" % message[0].get_id()
-            logging.debug(msg)
+            machine = message[0]
+            future = self._pop_pending_request(
+                machine, message[1].get("request_id", None)
+            )
+            if future is None:
+                msg = "Received unexpected result message from agent %s" % machine.get_id()
+                logging.debug(msg)
+                return
+            future.set_result(
+                deviceref_to_remote_device(machine, message[1]["result"], future.netns)
+            )
         elif message[1]["type"] == "dev_created":
             machine = self._machines[message[0]]
             try:
@@ -221,7 +338,11 @@ class MessageDispatcher(ConnectionHandler):
                 netns = None
             machine.device_netns_change(message[1], netns)
         elif message[1]["type"] == "exception":
-            raise message[1]["Exception"]
+            request_id = message[1].get("request_id", None)
+            if request_id is None:
+                raise message[1]["Exception"]
+            future = self._pop_pending_request(message[0], request_id)
+            future.set_exception(message[1]["Exception"])
         elif message[1]["type"] == "job_finished":
             machine = self._machines[message[0]]
             machine.job_finished(message[1])
@@ -231,6 +352,11 @@ class MessageDispatcher(ConnectionHandler):
 
     def _handle_disconnects(self, disconnected_agents):
         disconnected_agents = set(disconnected_agents)
+        for agent in disconnected_agents:
+            self._fail_pending_requests(agent, ConnectionError(
+                "Agent {} disconnected before returning a result".format(agent.get_id())
+            ))
+
         for agent in list(disconnected_agents):
             if not agent.get_mapped():
                 logging.warn("Agent {} soft-disconnected from the "
@@ -247,4 +373,8 @@ class MessageDispatcher(ConnectionHandler):
     def disconnect_agent(self, machine):
         soc = self.get_connection(machine)
         self.remove_connection(soc)
+        self._fail_pending_requests(machine, ConnectionError(
+            "Agent {} disconnected before returning a result".format(machine.get_id())
+        ))
         del self._machines[machine]
+        del self._pending_by_machine[machine]
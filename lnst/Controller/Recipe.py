@@ -20,6 +20,9 @@ from lnst.Common.Colours import decorate_with_preset
 from lnst.Controller.Requirements import _Requirements, HostReq
 from lnst.Controller.Common import ControllerError
 from lnst.Controller.RecipeResults import BaseResult, Result, ResultType
+from lnst.Controller.RunArchive import RunArchive, RunArchiveWriter
+
+_XZ_MAGIC = b"\xfd7zXZ\x00"
 
 class RecipeError(ControllerError):
     """Exception thrown by the BaseRecipe class"""
@@ -170,12 +173,13 @@ class BaseRecipe(object):
 
 
 class RecipeRun(object):
-    def __init__(self, recipe: BaseRecipe, match, desc=None, log_dir=None, log_list=None):
+    def __init__(self, recipe: BaseRecipe, match, desc=None, log_dir=None, log_store=None):
         self._match = match
         self._desc = desc
         self._results = []
         self._log_dir = log_dir
-        self._log_list = log_list
+        self._log_store = log_store
+        self._archive = None
         self._recipe = recipe
         self._datetime = datetime.datetime.now()
         self._environ = os.environ.copy()
@@ -186,6 +190,8 @@ class RecipeRun(object):
             raise RecipeError("result must be a BaseActionResult instance.")
 
         self._results.append(result)
+        if self._archive is not None:
+            self._archive.add_result(result)
 
         result_str = decorate_with_preset(
             str(result.result),
@@ -203,9 +209,18 @@ class RecipeRun(object):
     def log_dir(self):
         return self._log_dir
 
+    @property
+    def log_store(self):
+        """:py:class:`lnst.Common.LogStore.LogStore` with the logs of the run
+
+        Maps "controller" and the agent ids to lazily loaded sequences of
+        log records.
+        """
+        return self._log_store
+
     @property
     def log_list(self):
-        return self._log_list
+        return self._log_store
 
     @property
     def match(self):
@@ -253,9 +268,53 @@ class RecipeRun(object):
     def exception(self, exception):
         self._exception = exception
 
-def export_recipe_run(run: RecipeRun, export_dir: str = None, name: str = None) -> str:
+    def start_archive(self, path):
+        """Starts writing the run to an archive while it's running
+
+        Results are appended to the archive as they are added, the archive
+        is completed by :py:meth:`finish_archive`.
+        """
+        self._archive = RunArchiveWriter(path)
+        self._archive.write_metadata(self)
+        for result in self._results:
+            self._archive.add_result(result)
+
+    def finish_archive(self, embed_logs=True):
+        if self._archive is None:
+            return None
+
+        archive, self._archive = self._archive, None
+        try:
+            archive.write_metadata(self)
+            if embed_logs and self._log_store is not None:
+                archive.write_logs(self._log_store)
+        finally:
+            archive.close()
+        return archive.path
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_archive"] = None
+        return state
+
+    def __setstate__(self, state):
+        # runs exported before the log store kept the records in lists
+        if "_log_list" in state:
+            state["_log_store"] = state.pop("_log_list")
+        state.setdefault("_archive", None)
+        self.__dict__.update(state)
+
+def export_recipe_run(run: RecipeRun, export_dir: str = None, name: str = None,
+                      embed_logs: bool = True) -> str:
     """
-    Export a recipe run to a file. :py:class:`RecipeRun` is pickled and compressed.
+    Export a recipe run to a file. The file is a
+    :py:mod:`lnst.Controller.RunArchive` archive, the run metadata, each
+    result, each result's data and the logs are compressed separately so that
+    they can be loaded independently with :py:meth:`open_recipe_run`.
+
+    The log store of the run is exported as its raw files when `embed_logs`
+    is True, otherwise only its path is stored and the imported run reads the
+    logs from the original log directory.
 
     :param run: `RecipeRun` object to export.
     :type run: :py:class:`RecipeRun`
@@ -263,6 +322,8 @@ def export_recipe_run(run: RecipeRun, export_dir: str = None, name: str = None)
     :type export_dir: str
     :param name: Name of output (exclusive of directory). Defaults to `<recipename>-run-<timestamp>.lrc`.
     :type name: str
+    :param embed_logs: Include the logs in the exported file. Defaults to True.
+    :type embed_logs: bool
     :return: Path of output file.
     :rtype: str
 
@@ -280,21 +341,51 @@ def export_recipe_run(run: RecipeRun, export_dir: str = None, name: str = None)
 
     """
     if not name:
-        name = f"{run.recipe.__class__.__name__}-run-{run.datetime:%Y-%m-%d_%H:%M:%S}.lrc"
+        name = default_run_archive_name(run)
     if not export_dir:
         export_dir = run.log_dir
 
     path = os.path.join(export_dir, name)
-    with lzma.open(path, 'wb') as f:
-        pickle.dump(run, f)
+    with RunArchiveWriter(path) as archive:
+        archive.write_run(run, embed_logs=embed_logs)
     logging.info(f"Exported {run.recipe.__class__.__name__} run to {path}")
     return path
 
 
+def default_run_archive_name(run: RecipeRun) -> str:
+    return f"{run.recipe.__class__.__name__}-run-{run.datetime:%Y-%m-%d_%H:%M:%S}.lrc"
+
+
+def open_recipe_run(path: str) -> RunArchive:
+    """
+    Open a recipe run exported using :py:meth:`export_recipe_run` without
+    loading it. The returned :py:class:`lnst.Controller.RunArchive.RunArchive`
+    lists the results in its table of contents and loads the metadata, single
+    results, result data or logs on request.
+
+    :param path: Path to file to open
+    :type path:  str
+    :rtype:  :py:class:`lnst.Controller.RunArchive.RunArchive`
+
+    Example::
+
+        >>> from lnst.Controller.Recipe import open_recipe_run
+        >>> archive = open_recipe_run("/tmp/lnst-logs/2020-10-02_15:20:18/BondRecipe_match_0/BondRecipe-run-2020-10-02_15:20:58.lrc")
+        >>> archive.toc[38]
+        {'type': 'Result', 'result': 'PASS', 'timestamp': 1601644858.4, 'description': 'CPU Utilization on host host1: ...', 'index': 38, 'has_data': True}
+        >>> archive.data(38)
+        {'cpu': [[[<lnst.RecipeCommon.Perf.Results.PerfInterval object at 0x7f20727e1e50>,...]]], ... }
+    """
+    return RunArchive(path)
+
+
 def import_recipe_run(path: str) -> RecipeRun:
     """
     Import a recipe run that was exported using :py:meth:`export_recipe_run`
 
+    Files exported by older LNST versions, a single pickled and LZMA
+    compressed :py:class:`RecipeRun`, are supported as well.
+
     :param path: Path to file to import
     :type path:  str
     :return: object which contains the imported recipe run
@@ -317,6 +408,12 @@ def import_recipe_run(path: str) -> RecipeRun:
         cpu 'cpu': 45.40 +-0.00 time units per second
         cpu 'cpu0': 45.40 +-0.00 time units per second
     """
-    with lzma.open(path, 'rb') as f:
-        run = pickle.load(f)
-    return run
+    with open(path, 'rb') as f:
+        legacy = f.read(len(_XZ_MAGIC)) == _XZ_MAGIC
+
+    if legacy:
+        with lzma.open(path, 'rb') as f:
+            return pickle.load(f)
+
+    with RunArchive(path) as archive:
+        return archive.run()
@@ -0,0 +1,288 @@
+"""
+Defines the container format used for exported recipe runs.
+
+An archive is an uncompressed tar file of independently LZMA compressed
+members:
+
+* ``metadata`` - the pickled RecipeRun without its results, the LogStore of
+  the run is only referenced by its path
+* ``results/<n>`` - the n-th result without its data
+* ``data/<n>`` - the pickled data of the n-th result, if it has any
+* ``logs/<file>`` - the raw files of the LogStore of the run
+
+The PAX headers of the result members carry a summary of the result (type,
+description, result, timestamp) so the table of contents is built from the
+tar headers alone and a single result, or just its data, can be loaded
+without decompressing anything else.
+
+Members are only ever appended, results can be added while the run is still
+going and an archive cut short by a crash can still be read up to the last
+complete member. If a member is written more than once, the last one wins.
+
+Copyright 2023 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+__author__ = """
+olichtne@redhat.com (Ondrej Lichtner)
+"""
+
+import io
+import os
+import copy
+import lzma
+import pickle
+import tarfile
+import tempfile
+
+from lnst.Common.LogStore import LogStore
+from lnst.Controller.Common import ControllerError
+
+FORMAT_VERSION = "1"
+
+_PAX_PREFIX = "LNST."
+_COPY_CHUNK_SIZE = 1024*1024
+
+
+class RunArchiveError(ControllerError):
+    pass
+
+
+def _result_summary(result):
+    summary = {
+        "type": type(result).__name__,
+        "result": str(result.result),
+        "timestamp": repr(result.timestamp),
+    }
+    try:
+        summary["description"] = str(result.description)
+    except Exception:
+        summary["description"] = ""
+    measurement_type = getattr(result, "measurement_type", None)
+    if measurement_type is not None:
+        summary["measurement_type"] = str(measurement_type)
+    return summary
+
+
+class RunArchiveWriter(object):
+    """Writes a recipe run to an archive, member by member
+
+    :param path: path of the archive file
+    :type path: str
+    :param append: continue an existing archive instead of overwriting it
+    :type append: bool
+    """
+    def __init__(self, path, append=False):
+        self._path = path
+        self._next_result = 0
+
+        if append and os.path.exists(path):
+            with RunArchive(path) as archive:
+                self._next_result = len(archive.toc)
+            self._tar = tarfile.open(path, "a", format=tarfile.PAX_FORMAT)
+        else:
+            self._tar = tarfile.open(path, "w", format=tarfile.PAX_FORMAT)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _add_member(self, name, fileobj, size, pax_headers=None):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.pax_headers = dict(pax_headers or {})
+        info.pax_headers[_PAX_PREFIX + "version"] = FORMAT_VERSION
+        self._tar.addfile(info, fileobj)
+        # keep everything written so far readable if the controller dies
+        self._tar.fileobj.flush()
+
+    def _add_object(self, name, obj, pax_headers=None):
+        data = lzma.compress(pickle.dumps(obj))
+        self._add_member(name, io.BytesIO(data), len(data), pax_headers)
+
+    def _add_stream(self, name, stream, pax_headers=None):
+        compressor = lzma.LZMACompressor()
+        with tempfile.TemporaryFile() as tmp:
+            for chunk in iter(lambda: stream.read(_COPY_CHUNK_SIZE), b""):
+                tmp.write(compressor.compress(chunk))
+            tmp.write(compressor.flush())
+            size = tmp.tell()
+            tmp.seek(0)
+            self._add_member(name, tmp, size, pax_headers)
+
+    def write_metadata(self, run):
+        """Writes the run itself, without results and logs"""
+        shell = copy.copy(run)
+        shell._results = []
+        shell._archive = None
+
+        # the recipe references all of its runs including their results
+        recipe = copy.copy(run.recipe)
+        recipe.runs = []
+        shell._recipe = recipe
+
+        self._add_object("metadata", shell)
+
+    def add_result(self, result):
+        """Appends a result, its data is stored as a separate member"""
+        index = self._next_result
+        self._next_result += 1
+
+        summary = {_PAX_PREFIX + k: v for k, v in _result_summary(result).items()}
+
+        data = getattr(result, "_data", None)
+        if data is not None:
+            self._add_object("data/%d" % index, data)
+            result = copy.copy(result)
+            result._data = None
+            summary[_PAX_PREFIX + "has_data"] = "1"
+
+        self._add_object("results/%d" % index, result, summary)
+
+    def write_logs(self, log_store):
+        """Copies the files of a LogStore into the archive"""
+        log_store.flush()
+        for name in log_store.file_names():
+            with log_store.open_file(name) as f:
+                self._add_stream("logs/" + name, f,
+                                 {_PAX_PREFIX + "path": log_store.path})
+
+    def write_run(self, run, embed_logs=True):
+        self.write_metadata(run)
+        for result in run.results:
+            self.add_result(result)
+        if embed_logs and run.log_store is not None:
+            self.write_logs(run.log_store)
+
+    def close(self):
+        self._tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RunArchive(object):
+    """Lazily loaded recipe run archive
+
+    Only the tar headers are read when opening the archive, members are
+    decompressed and unpickled when requested.
+
+    :param path: path of the archive file
+    :type path: str
+    """
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "rb")
+        self._members = {}
+        self._toc = []
+
+        file_size = os.fstat(self._file.fileno()).st_size
+        try:
+            tar = tarfile.open(fileobj=self._file, mode="r:")
+            for info in iter(tar.next, None):
+                if info.offset_data + info.size > file_size:
+                    break
+                self._members[info.name] = info
+        except tarfile.ReadError as e:
+            # an archive cut short while being written is read up to the
+            # last complete member
+            if not self._members:
+                self._file.close()
+                raise RunArchiveError("Not a recipe run archive '%s': %s" % (path, e))
+
+        if "metadata" not in self._members:
+            self._file.close()
+            raise RunArchiveError("Recipe run archive '%s' has no metadata" % path)
+
+        i = 0
+        while "results/%d" % i in self._members:
+            headers = self._members["results/%d" % i].pax_headers
+            entry = {k[len(_PAX_PREFIX):]: v for k, v in headers.items()
+                     if k.startswith(_PAX_PREFIX)}
+            entry["index"] = i
+            entry["has_data"] = entry.get("has_data") == "1"
+            entry["timestamp"] = float(entry["timestamp"])
+            del entry["version"]
+            self._toc.append(entry)
+            i += 1
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def toc(self):
+        """List of result summaries, dicts with the keys index, type,
+        description, result, timestamp, has_data and for measurement results
+        also measurement_type"""
+        return self._toc
+
+    def _read(self, name):
+        info = self._members[name]
+        self._file.seek(info.offset_data)
+        data = self._file.read(info.size)
+        if len(data) < info.size:
+            raise RunArchiveError("Member '%s' of '%s' is truncated" % (name, self._path))
+        return lzma.decompress(data)
+
+    def _load(self, name):
+        return pickle.loads(self._read(name))
+
+    def metadata(self):
+        """Returns the RecipeRun without results
+
+        The log store of the returned run refers to the original log
+        directory, use log_store() for the logs stored in the archive.
+        """
+        run = self._load("metadata")
+        run.recipe.runs = [run]
+        return run
+
+    def data(self, index):
+        """Returns the data of a single result"""
+        if not self._toc[index]["has_data"]:
+            return None
+        return self._load("data/%d" % index)
+
+    def result(self, index, with_data=True):
+        result = self._load("results/%d" % index)
+        if with_data and self._toc[index]["has_data"]:
+            result._data = self.data(index)
+        return result
+
+    def results(self, with_data=True):
+        return [self.result(i, with_data) for i in range(len(self._toc))]
+
+    def log_store(self):
+        """Returns the LogStore of the run or None if logs weren't exported"""
+        files = {}
+        path = None
+        for name, info in self._members.items():
+            if name.startswith("logs/"):
+                files[name[len("logs/"):]] = self._read(name)
+                path = info.pax_headers.get(_PAX_PREFIX + "path", "")
+        if not files:
+            return None
+        return LogStore.from_files(path, files)
+
+    def run(self):
+        """Returns the whole RecipeRun including all results and logs"""
+        run = self.metadata()
+        run._results = self.results()
+        log_store = self.log_store()
+        if log_store is not None:
+            run._log_store = log_store
+        return run
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
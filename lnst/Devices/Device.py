@@ -293,6 +293,13 @@ class Device(object, metaclass=DeviceMeta):
                 self._ip_addrs.remove(addr)
 
     def _get_if_data(self):
+        """Device data used for device enumeration
+
+        Contains only the attributes derived from the netlink messages we
+        already have, so that enumerating hundreds of devices doesn't need to
+        query ethtool for each of them. Use _get_ethtool_data() when the
+        ethtool settings are actually needed.
+        """
         if_data = {"ifindex": self.ifindex,
                    "hwaddr": self.hwaddr,
                    "name": self.name,
@@ -303,21 +310,35 @@ class Device(object, metaclass=DeviceMeta):
                    "mtu": self.mtu,
                    "driver": self.driver,
                    "devlink": self._devlink}
+        return if_data
+
+    def _get_ethtool_data(self, coalescing_output=None):
+        ethtool_data = {}
         try:
-            ad_rx_coal, ad_tx_coal = self._read_adaptive_coalescing()
+            ad_rx_coal, ad_tx_coal = self._read_adaptive_coalescing(coalescing_output)
         except DeviceError:
             ad_rx_coal, ad_tx_coal = None, None
-        if_data["adaptive_rx_coalescing"] = ad_rx_coal
-        if_data["adaptive_tx_coalescing"] = ad_tx_coal
+        ethtool_data["adaptive_rx_coalescing"] = ad_rx_coal
+        ethtool_data["adaptive_tx_coalescing"] = ad_tx_coal
 
         try:
             rx_pause, tx_pause = self._read_pause_frames()
         except DeviceError:
             rx_pause, tx_pause = None, None
-        if_data["rx_pause"] = rx_pause
-        if_data["tx_pause"] = tx_pause
+        ethtool_data["rx_pause"] = rx_pause
+        ethtool_data["tx_pause"] = tx_pause
 
-        return if_data
+        return ethtool_data
+
+    def _match_if_data(self, params):
+        if_data = self._get_if_data()
+        if not set(params.keys()).issubset(if_data.keys()):
+            if_data.update(self._get_ethtool_data())
+
+        for key, value in params.items():
+            if key not in if_data or if_data[key] != value:
+                return False
+        return True
 
     def _vars(self):
         ret = {}
@@ -357,24 +378,13 @@ class Device(object, metaclass=DeviceMeta):
                 "mtu": self.mtu,
                 "name": self.name,
                 "hwaddr": self.hwaddr}
-        try:
-            ad_rx_coal, ad_tx_coal = self._read_adaptive_coalescing()
-        except DeviceError:
-            ad_rx_coal, ad_tx_coal = None, None
-        self._cleanup_data["adaptive_rx_coalescing"] = ad_rx_coal
-        self._cleanup_data["adaptive_tx_coalescing"] = ad_tx_coal
-
-        try:
-            rx_pause, tx_pause = self._read_pause_frames()
-        except DeviceError:
-            rx_pause, tx_pause = None, None
-        self._cleanup_data.update(
-                {
-                    "rx_pause": rx_pause,
-                    "tx_pause": tx_pause
-                })
 
-        self._cleanup_data["coalescing_settings"] = self._read_coalescing_settings()
+        # the adaptive and the other coalescing settings come from the same
+        # ethtool query
+        coalescing_output = self._query_coalescing()
+        self._cleanup_data.update(self._get_ethtool_data(coalescing_output))
+        self._cleanup_data["coalescing_settings"] = \
+            self._read_coalescing_settings(coalescing_output)
 
     def restore_original_data(self):
         """Restores initial configuration from stored values"""
@@ -396,9 +406,10 @@ class Device(object, metaclass=DeviceMeta):
         except DeviceError as e:
             logging.warn(e)
 
-        # the device needs to be up to configure the pause frame settings
-        self.up()
-        self.restore_pause_frames()
+        if not self._pause_frames_restored():
+            # the device needs to be up to configure the pause frame settings
+            self.up()
+            self.restore_pause_frames()
         self.down()
 
         self._cleanup_data = None
@@ -671,6 +682,7 @@ class Device(object, metaclass=DeviceMeta):
 
         Returns dictionary of interface statistics, IFLA_STATS
         """
+        self._if_manager.refresh_device(self.ifindex)
         return self._nl_msg.get_attr("IFLA_STATS")
 
     @property
@@ -679,6 +691,7 @@ class Device(object, metaclass=DeviceMeta):
 
         Returns dictionary of interface statistics, IFLA_STATS64
         """
+        self._if_manager.refresh_device(self.ifindex)
         return self._nl_msg.get_attr("IFLA_STATS64")
 
     @property
@@ -809,8 +822,12 @@ class Device(object, metaclass=DeviceMeta):
         """disable automatic negotiation of speed for this device"""
         exec_cmd("ethtool -s %s autoneg off" % self.name)
 
-    def _read_adaptive_coalescing(self):
+    def _query_coalescing(self):
         res, _ = exec_cmd("ethtool -c %s" % self.name, die_on_err=False)
+        return res
+
+    def _read_adaptive_coalescing(self, output=None):
+        res = output if output is not None else self._query_coalescing()
 
         regex = "Adaptive RX: (on|off)  TX: (on|off)"
         try:
@@ -833,18 +850,22 @@ class Device(object, metaclass=DeviceMeta):
             )
 
     def restore_coalescing(self):
-        for setting, value in self._cleanup_data["coalescing_settings"].items():
-            if value != 'n/a':
-                self._write_coalescing_setting(setting, value)
+        current = self._read_coalescing_settings()
+        changed = {setting: value
+                   for setting, value in self._cleanup_data["coalescing_settings"].items()
+                   if value != 'n/a' and current.get(setting) != value}
+        if changed:
+            self._write_coalescing_settings(changed)
 
         rx_val = self._cleanup_data["adaptive_rx_coalescing"]
         tx_val = self._cleanup_data["adaptive_tx_coalescing"]
         if (rx_val, tx_val) != (None, None):
             self._write_adaptive_coalescing(rx_val, tx_val)
 
-    def _read_coalescing_settings(self):
+    def _read_coalescing_settings(self, output=None):
         settings = {}
-        output, _ = exec_cmd("ethtool -c %s" % self.name, die_on_err=False)
+        if output is None:
+            output = self._query_coalescing()
 
         regex = re.compile(r"^([a-z-]+):\s+(n/a|\d+)$")
 
@@ -865,6 +886,16 @@ class Device(object, metaclass=DeviceMeta):
                 f"Not allowed to modify coalescence settings {setting} for {self.name}."
             )
 
+    def _write_coalescing_settings(self, settings):
+        opts = " ".join(f"{setting} {value}" for setting, value in settings.items())
+        try:
+            exec_cmd(f"ethtool -C {self.name} {opts}")
+        except:
+            # some drivers reject the whole command if any of the settings
+            # can't be changed, apply what can be applied one by one
+            for setting, value in settings.items():
+                self._write_coalescing_setting(setting, value)
+
     @property
     def rx_pause_frames(self):
         try:
@@ -953,6 +984,16 @@ class Device(object, metaclass=DeviceMeta):
 
         return True
 
+    def _pause_frames_restored(self):
+        rx_val = self._cleanup_data["rx_pause"]
+        tx_val = self._cleanup_data["tx_pause"]
+        if (rx_val, tx_val) == (None, None):
+            return True
+        try:
+            return self._pause_frames_match(rx_val, tx_val)
+        except Exception:
+            return False
+
     def restore_pause_frames(self):
         rx_val = self._cleanup_data["rx_pause"]
         tx_val = self._cleanup_data["tx_pause"]
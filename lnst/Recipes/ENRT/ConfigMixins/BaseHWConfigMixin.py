@@ -1,3 +1,5 @@
+from contextlib import ExitStack
+
 from lnst.Recipes.ENRT.ConfigMixins.BaseSubConfigMixin import BaseSubConfigMixin
 
 class BaseHWConfigMixin(BaseSubConfigMixin):
@@ -31,7 +33,12 @@ class BaseHWConfigMixin(BaseSubConfigMixin):
         for dev in dev_list:
             attr_cfg[dev] = {}
             attr_cfg[dev]["original"] = getattr(dev, attr_name)
-            setattr(dev, attr_name, value)
+
+        with self._batch_dev_config(dev_list):
+            for dev in dev_list:
+                setattr(dev, attr_name, value)
+
+        for dev in dev_list:
             attr_cfg[dev]["configured"] = getattr(dev, attr_name)
 
     def _deconfigure_dev_attribute(self, config, dev_list, attr_name):
@@ -42,11 +49,23 @@ class BaseHWConfigMixin(BaseSubConfigMixin):
         except KeyError:
             return
 
+        with self._batch_dev_config(dev_list):
+            for dev in dev_list:
+                value = attr_cfg[dev]["original"]
+                setattr(dev, attr_name, value)
+
         for dev in dev_list:
-            value = attr_cfg[dev]["original"]
-            setattr(dev, attr_name, value)
             del attr_cfg[dev]
 
+    def _batch_dev_config(self, dev_list):
+        stack = ExitStack()
+        hosts = []
+        for dev in dev_list:
+            if not any(dev.host is host for host in hosts):
+                hosts.append(dev.host)
+                stack.enter_context(dev.host.batch())
+        return stack
+
     def _describe_dev_attribute(self, config, attr_name):
         hw_config = config.hw_config
         res = []
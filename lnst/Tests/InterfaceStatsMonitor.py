@@ -55,10 +55,6 @@ class InterfaceStatsMonitor(BaseTestModule):
         try:
             old_handler = signal.signal(signal.SIGINT, sigint_handler)
             while True:
-                self.params.device._if_manager.rescan_devices()
-                # ^ needs to rescan devices to update netlink msg
-                # where stats are fetched from
-
                 res = self.params.device.link_stats64
 
                 sample = {"timestamp": time.time()}
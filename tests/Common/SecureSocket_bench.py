@@ -0,0 +1,144 @@
+"""
+Microbenchmark of the SecureSocket message framing.
+
+Compares the current single frame AES-GCM framing against the previous
+framing (pickle, HMAC signature pickled together with the data, padding and
+AES-CBC encryption pickled together with the IV, ASCII length prefix) by
+sending messages over a local socket pair.
+
+Run with: python -m tests.Common.SecureSocket_bench
+"""
+
+import os
+import hmac
+import pickle
+import socket
+import hashlib
+import threading
+import time
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from lnst.Common.SecureSocket import SecureSocket
+
+
+class LegacySecureSocket(object):
+    """The framing SecureSocket used before the binary frame format"""
+    def __init__(self, soc, enc_key, mac_key):
+        self._socket = soc
+        self._enc_key = enc_key
+        self._mac_key = mac_key
+        self._write_seq = 0
+        self._read_seq = 0
+
+    def send_msg(self, msg):
+        data = pickle.dumps(msg)
+
+        signed = (str(self._write_seq).encode("ascii")
+                  + str(len(data)).encode("ascii") + data)
+        signature = hmac.new(self._mac_key, signed, hashlib.sha256).digest()
+        data = pickle.dumps({"data": data, "signature": signature})
+
+        pad_length = 16 - (len(data) % 16)
+        data += pad_length * bytes([pad_length])
+
+        iv = os.urandom(16)
+        encryptor = Cipher(algorithms.AES(self._enc_key), modes.CBC(iv)).encryptor()
+        data = pickle.dumps({"iv": iv,
+                             "enc_data": encryptor.update(data) + encryptor.finalize()})
+
+        self._write_seq += 1
+        self._socket.sendall(str(len(data)).encode("ascii") + b" " + data)
+
+    def recv_msg(self):
+        length = b""
+        while True:
+            c = self._socket.recv(1)
+            if c == b" ":
+                break
+            length += c
+        length = int(length)
+
+        data = b""
+        while len(data) < length:
+            data += self._socket.recv(length - len(data))
+
+        encrypted = pickle.loads(data)
+        decryptor = Cipher(algorithms.AES(self._enc_key),
+                           modes.CBC(encrypted["iv"])).decryptor()
+        data = decryptor.update(encrypted["enc_data"]) + decryptor.finalize()
+        data = data[:-data[-1]]
+
+        signed_msg = pickle.loads(data)
+        data = signed_msg["data"]
+        signed = (str(self._read_seq).encode("ascii")
+                  + str(len(data)).encode("ascii") + data)
+        signature = hmac.new(self._mac_key, signed, hashlib.sha256).digest()
+        if signature != signed_msg["signature"]:
+            raise Exception("Signature mismatch")
+
+        self._read_seq += 1
+        return pickle.loads(data)
+
+
+def secure_socket_pair():
+    a, b = socket.socketpair()
+    client = SecureSocket(a)
+    client._role = "client"
+    server = SecureSocket(b)
+    server._role = "server"
+
+    master_secret = os.urandom(48)
+    ctl_random = os.urandom(28)
+    agent_random = os.urandom(28)
+    for soc in [client, server]:
+        soc._master_secret = master_secret
+        soc._ctl_random = ctl_random
+        soc._agent_random = agent_random
+        soc._init_cipher_spec()
+        soc._change_read_cipher_spec()
+        soc._change_write_cipher_spec()
+    return client, server
+
+
+def legacy_socket_pair():
+    a, b = socket.socketpair()
+    enc_key = os.urandom(32)
+    mac_key = os.urandom(64)
+    return (LegacySecureSocket(a, enc_key, mac_key),
+            LegacySecureSocket(b, enc_key, mac_key))
+
+
+def run(sender, receiver, payload_size, count):
+    msg = {"type": "result", "result": os.urandom(payload_size)}
+
+    def receive():
+        for _ in range(count):
+            receiver.recv_msg()
+
+    receiver_thread = threading.Thread(target=receive)
+    start = time.perf_counter()
+    receiver_thread.start()
+    for _ in range(count):
+        sender.send_msg(msg)
+    receiver_thread.join()
+    duration = time.perf_counter() - start
+
+    return count / duration, count * payload_size / duration
+
+
+def main():
+    cases = [(64, 20000), (4096, 20000), (1024*1024, 200)]
+    print("{:>10} {:>10} {:>14} {:>14}".format("payload", "framing",
+                                               "msgs/s", "MiB/s"))
+    for payload_size, count in cases:
+        for name, pair in [("legacy", legacy_socket_pair),
+                           ("aead", secure_socket_pair)]:
+            sender, receiver = pair()
+            msgs, nbytes = run(sender, receiver, payload_size, count)
+            print("{:>10} {:>10} {:>14.0f} {:>14.2f}".format(
+                payload_size, name, msgs, nbytes / (1024*1024)))
+
+
+if __name__ == "__main__":
+    main()